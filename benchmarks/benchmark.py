@@ -0,0 +1,222 @@
+"""
+Scalability benchmarks of the langerhans pipeline on synthetic islets.
+
+Every stage of Data, Networks.build_networks, the Analysis parameter
+methods, wave detection and GlobalAnalysis is timed (wall and CPU time)
+and its peak traced memory is measured for all combinations of the given
+cell and point numbers. Scaling exponents are fitted on log-log scale.
+
+    python benchmarks/benchmark.py --cells 25 50 100 --points 6000
+"""
+import numpy as np
+
+import sys
+import json
+import time
+import pickle
+import argparse
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from langerhans import Data, Analysis, Networks, GlobalAnalysis
+from synthetic import synthetic_islet, synthetic_settings
+
+
+def measure(function, memory=True):
+    if memory:
+        tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = function()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    peak = 0
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return (result, {"wall [s]": wall, "cpu [s]": cpu, "peak [MB]": peak/2**20})
+
+
+def analyzed_data(cells, points, seed=0, glucose=8, autolimit="exact"):
+    signal, positions = synthetic_islet(cells, points, seed=seed)
+    data = Data()
+    data.import_settings(synthetic_settings(points, glucose=glucose))
+    data.import_data(signal)
+    data.filter()
+    data.compute_distributions()
+    data.binarize_fast()
+    data.binarize_slow()
+    data.autolimit(autolimit)
+    return (data, positions)
+
+
+def benchmark_size(cells, points, autolimit="exact", memory=True, waves=True,
+                   series=4
+                   ):
+    results = []
+
+    def record(stage, function):
+        result, row = measure(function, memory)
+        row.update({"stage": stage, "cells": cells, "points": points})
+        results.append(row)
+        return result
+
+    signal, positions = synthetic_islet(cells, points)
+    data = Data()
+    data.import_settings(synthetic_settings(points))
+
+    # Data stages
+    record("Data.import_data", lambda: data.import_data(signal))
+    record("Data.filter", data.filter)
+    record("Data.compute_distributions", data.compute_distributions)
+    record("Data.autoexclude", data.autoexclude)
+    record("Data.binarize_fast", data.binarize_fast)
+    record("Data.binarize_slow", data.binarize_slow)
+    record("Data.autolimit", lambda: data.autolimit(autolimit))
+
+    # Networks
+    analysis = Analysis()
+    analysis.import_data(data, positions)
+    good = np.sum(data.get_good_cells())
+    filtered_slow = analysis.get_filtered_slow()
+    filtered_fast = analysis.get_filtered_fast()
+    networks = Networks(good, filtered_slow, filtered_fast)
+    record("Networks.build_networks", networks.build_networks)
+
+    # Analysis parameter methods over all cells
+    record("Analysis.build_networks", analysis.build_networks)
+    for method in ("activity", "frequency", "interspike", "time",
+                   "node_degree", "clustering", "nearest_neighbour_degree"
+                   ):
+        function = getattr(analysis, method)
+        record("Analysis.{0}".format(method),
+               lambda: [function(cell) for cell in range(good)]
+               )
+    for method in ("amplitudes", "average_correlation",
+                   "connection_distances", "modularity", "global_efficiency",
+                   "max_connected_component", "spikes_vs_phase",
+                   "correlation_vs_distance", "get_parameters"
+                   ):
+        record("Analysis.{0}".format(method), getattr(analysis, method))
+    if waves:
+        record("Analysis.wave_detection", analysis.wave_detection)
+        record("Analysis.wave_characterization",
+               analysis.wave_characterization
+               )
+
+    # GlobalAnalysis over pickled series of both glucose concentrations
+    if series > 0:
+        with tempfile.TemporaryDirectory() as directory:
+            for s in range(series):
+                glucose = 8 if s % 2 == 0 else 12
+                data, positions = analyzed_data(cells, points, seed=s,
+                                                glucose=glucose,
+                                                autolimit=autolimit
+                                                )
+                with open(Path(directory) / "{0}.pkl".format(s), "wb") as f:
+                    pickle.dump(data, f)
+                np.savetxt(Path(directory) / "{0}.txt".format(s), positions)
+            record("GlobalAnalysis", lambda: GlobalAnalysis(directory))
+
+    return results
+
+
+def scaling(results, variable):
+    # Exponent of wall time in the variable, the other size is fixed
+    other = "points" if variable == "cells" else "cells"
+    exponents = []
+    stages = list(dict.fromkeys(r["stage"] for r in results))
+    for stage in stages:
+        for fixed in sorted(set(r[other] for r in results)):
+            rows = [r for r in results
+                    if r["stage"] == stage and r[other] == fixed
+                    ]
+            if len(rows) < 2:
+                continue
+            x = np.log([r[variable] for r in rows])
+            y = np.log([max(r["wall [s]"], 1e-9) for r in rows])
+            exponents.append({"stage": stage, "variable": variable,
+                              other: fixed,
+                              "exponent": np.polyfit(x, y, 1)[0]
+                              })
+    return exponents
+
+
+def report(results, exponents):
+    print("{:<36} {:>7} {:>8} {:>10} {:>10} {:>10}".format(
+        "Stage", "Cells", "Points", "Wall [s]", "CPU [s]", "Peak [MB]"
+        ))
+    for r in results:
+        print("{:<36} {:>7} {:>8} {:>10.4f} {:>10.4f} {:>10.1f}".format(
+            r["stage"], r["cells"], r["points"], r["wall [s]"], r["cpu [s]"],
+            r["peak [MB]"]
+            ))
+    if exponents:
+        print("\n{:<36} {:>8} {:>10}".format("Stage", "Scaling", "Exponent"))
+        for e in exponents:
+            print("{:<36} {:>8} {:>10.2f}".format(
+                e["stage"], e["variable"], e["exponent"]
+                ))
+
+
+def plot(results, path, variable="cells"):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(8, 6))
+    for stage in dict.fromkeys(r["stage"] for r in results):
+        rows = sorted((r for r in results if r["stage"] == stage),
+                      key=lambda r: (r[variable], r["cells"]*r["points"])
+                      )
+        ax.plot([r[variable] for r in rows], [r["wall [s]"] for r in rows],
+                "o-", label=stage
+                )
+    ax.set_xscale("log")
+    ax.set_yscale("log")
+    ax.set_xlabel(variable.capitalize())
+    ax.set_ylabel("Wall time [s]")
+    ax.legend(fontsize=5, ncol=2)
+    fig.savefig(path, dpi=200)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--cells", type=int, nargs="+", default=[25, 50, 100])
+    parser.add_argument("--points", type=int, nargs="+", default=[6000])
+    parser.add_argument("--autolimit", choices=("exact", "evolution"),
+                        default="exact"
+                        )
+    parser.add_argument("--series", type=int, default=4,
+                        help="pickled series for GlobalAnalysis, 0 skips it"
+                        )
+    parser.add_argument("--no-waves", action="store_true")
+    parser.add_argument("--no-memory", action="store_true")
+    parser.add_argument("--output", help="JSON file of all measurements")
+    parser.add_argument("--plot", help="image file of the scaling curves")
+    args = parser.parse_args(argv)
+
+    results = []
+    for points in args.points:
+        for cells in args.cells:
+            results += benchmark_size(cells, points, args.autolimit,
+                                      not args.no_memory, not args.no_waves,
+                                      args.series
+                                      )
+    exponents = scaling(results, "cells") + scaling(results, "points")
+    report(results, exponents)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"results": results, "scaling": exponents}, f,
+                      indent=2
+                      )
+    if args.plot:
+        plot(results, args.plot,
+             "cells" if len(args.cells) > 1 else "points"
+             )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import numpy as np
+
+from langerhans.data import SAMPLE_SETTINGS
+
+# Slow cycles at least within the active part of short recordings
+SLOW_CYCLES = 2
+
+
+def activation_delays(points, sampling=10):
+    # Range of activation delays after stimulation [s], 30-90 s for
+    # recordings of 10 minutes or longer and shorter for shorter ones
+    scale = min(1, points/sampling/600)
+    return (30*scale, 90*scale)
+
+
+def default_slow_frequency(points, sampling=10, stimulation=None,
+                           frequency=0.003
+                           ):
+    """
+    Frequency of slow oscillations [Hz], raised above the given frequency
+    when the recording after the latest activation is shorter than
+    SLOW_CYCLES periods, so every cell has full slow cycles while active.
+    """
+    if stimulation is None:
+        stimulation = points//5
+    active = (points - stimulation)/sampling - activation_delays(
+        points, sampling
+        )[1]
+    return max(frequency, SLOW_CYCLES/active)
+
+
+def synthetic_settings(points, sampling=10, stimulation=None, glucose=8):
+    """
+    Returns a copy of the sample settings for a synthetic recording, with
+    the stimulation starting at one fifth of the recording by default. The
+    slow band follows the slow frequency of synthetic_islet.
+    """
+    if stimulation is None:
+        stimulation = points//5
+    settings = dict(SAMPLE_SETTINGS)
+    settings["Filter"] = dict(SAMPLE_SETTINGS["Filter"])
+    settings["Exclude"] = dict(SAMPLE_SETTINGS["Exclude"])
+    settings["Glucose [mM]"] = glucose
+    settings["Sampling [Hz]"] = sampling
+    settings["Stimulation [frame]"] = [stimulation, 0]
+    settings["Filter"]["Plot [s]"] = [0, points/sampling]
+    # Band around the slow frequency in the proportions of the sample band
+    frequency = default_slow_frequency(points, sampling, stimulation)
+    settings["Filter"]["Slow [Hz]"] = [frequency/3, frequency*5/3]
+    return settings
+
+
+def synthetic_islet(cells, points, sampling=10, stimulation=None,
+                    slow_frequency=None, fast_frequency=0.1, noise=0.05,
+                    size=100, seed=0
+                    ):
+    """
+    Generates calcium signals of an islet in the layout of
+    Data.import_data, i.e. a (points, cells+1) array with time in the first
+    column, together with (cells, 2) cell positions in um.
+
+    Every cell oscillates slowly, a wave starting at a random pacemaker
+    delays the oscillation with distance. After stimulation cells fire
+    fast spikes, mostly during the rising phase of the slow oscillation
+    and partly synchronized with their neighbours. Cells activate with a
+    random delay of 30-90 s after stimulation, shortened for recordings
+    under 10 minutes. The slow frequency defaults to 0.003 Hz, raised for
+    short recordings (see default_slow_frequency).
+    """
+    rng = np.random.default_rng(seed)
+    if stimulation is None:
+        stimulation = points//5
+    if slow_frequency is None:
+        slow_frequency = default_slow_frequency(points, sampling, stimulation)
+    time = np.arange(points)/sampling
+    positions = rng.uniform(0, size, (cells, 2))
+
+    # Slow oscillations travel from a pacemaker cell
+    distance = np.linalg.norm(positions - positions[rng.integers(cells)],
+                              axis=1
+                              )
+    delay = distance/size*0.25/slow_frequency
+    phase = 2*np.pi*slow_frequency*(time[np.newaxis, :]-delay[:, np.newaxis])
+    slow = 0.5*np.sin(phase)
+
+    # Spikes are more likely in the rising phase after activation
+    activation = stimulation + rng.uniform(
+        *activation_delays(points, sampling), cells
+        )*sampling
+    active = np.arange(points)[np.newaxis, :] >= activation[:, np.newaxis]
+    rate = fast_frequency/sampling*(1 + np.cos(phase))*active
+    common = rng.random(points) < fast_frequency/sampling
+    own = rng.random((cells, points)) < rate
+    near = distance < size/2
+    spikes = own | (common[np.newaxis, :] & near[:, np.newaxis] & active)
+
+    # Calcium transient of a spike decays exponentially
+    kernel = np.exp(-np.arange(int(3*sampling))/(0.5*sampling))
+    fast = np.empty((cells, points))
+    for cell in range(cells):
+        fast[cell] = np.convolve(spikes[cell], kernel)[:points]
+
+    drift = np.linspace(0, 0.5, points)[np.newaxis, :]*rng.random((cells, 1))
+    signal = 10 + drift + slow*active + 0.3*fast
+    signal += noise*rng.standard_normal((cells, points))
+
+    return (np.column_stack((time, signal.transpose())), positions)
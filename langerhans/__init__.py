@@ -2,3 +2,7 @@ from .data import Data
 from .analysis import Analysis
 from .networks import Networks
 from .global_analysis import GlobalAnalysis
+from .streaming import StreamingData
+from .cache import StageCache
+from .instrumentation import Profiler
+from .sweep import ParameterSweep
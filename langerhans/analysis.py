@@ -1,7 +1,11 @@
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy import sparse
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import pdist, cdist, squareform
 
-from .networks import Networks
+from .networks import Networks, correlation_matrix
+from .instrumentation import instrumented
 
 
 class Analysis(object):
@@ -21,9 +25,23 @@ class Analysis(object):
         self.__act_sig = None
 
         self.__networks = False
+        self.__network_options = False
+        self.__distances = False
+        self.__tree = False
 
+    def __counts(self, result=None):
+        return {"cells": self.__cells, "points": self.__points}
+
+    def __events(self, result=None):
+        events = np.unique(self.__act_sig[self.__act_sig != 0]).size
+        return {"cells": self.__cells, "points": self.__points,
+                "events": events
+                }
+
+    @instrumented("Analysis.import_data", __counts)
     def import_data(self, data, positions):
-        assert data.is_analyzed()
+        if not data.is_analyzed():
+            data.analyze()
 
         good_cells = data.get_good_cells()
 
@@ -32,24 +50,38 @@ class Analysis(object):
         self.__points = data.get_points()
         distance = self.__settings["Distance [um]"]
         self.__positions = positions[good_cells]*distance
+        self.__distances = False
+        self.__tree = False
         self.__cells = np.sum(good_cells)
 
         self.__filtered_slow = data.get_filtered_slow()[good_cells]
         self.__filtered_fast = data.get_filtered_fast()[good_cells]
 
-        self.__binarized_slow = data.get_binarized_slow()[good_cells]
-        self.__binarized_fast = data.get_binarized_fast()[good_cells]
+        self.__binarized_slow = data.get_binarized_slow(good_cells)
+        self.__binarized_fast = data.get_binarized_fast(good_cells)
 
         self.__activity = np.array(data.get_activity())[good_cells]
 
-    def build_networks(self):
+        # Networks of previously imported cells are not reused
+        self.__networks = False
+        self.__network_options = False
+
+    @instrumented("Analysis.build_networks", __counts)
+    def build_networks(self, ND_avg=8, dtype="float64", block=None,
+                       mode="bisect"
+                       ):
         print("Building networks...")
-        # Construct networks and build networks from data
-        self.__networks = Networks(self.__cells,
-                                   self.__filtered_slow,
-                                   self.__filtered_fast
-                                   )
-        self.__networks.build_networks()
+        # Construct networks once, rebuilding with the same options reuses
+        # correlation matrices
+        if self.__networks is False or \
+                self.__network_options != (dtype, block):
+            self.__network_options = (dtype, block)
+            self.__networks = Networks(self.__cells,
+                                       self.__filtered_slow,
+                                       self.__filtered_fast,
+                                       ND_avg, dtype, block
+                                       )
+        self.__networks.build_networks(ND_avg, mode)
 
 # ---------------------------- ANALYSIS FUNCTIONS ----------------------------
     def __search_sequence(self, arr, seq):
@@ -67,30 +99,64 @@ class Analysis(object):
 
         # Get the range of those indices as final output
         if M.any() > 0:
-            return np.where(M is True)[0]
+            return np.where(M)[0]
         else:
             return np.array([], dtype="int")  # No match found
 
-    def __distances_matrix(self):
-        A_dst = np.zeros((self.__cells, self.__cells))
-        for cell1 in range(self.__cells):
-            for cell2 in range(cell1):
-                x1, y1 = self.__positions[cell1, 0], self.__positions[cell1, 1]
-                x2, y2 = self.__positions[cell2, 0], self.__positions[cell2, 1]
-                distance = np.sqrt((x1-x2)**2 + (y1-y2)**2)
-                A_dst[cell1, cell2] = distance
-                A_dst[cell2, cell1] = distance
-        return A_dst
+    def __pair_distances(self, rows, columns):
+        # Distances of the given pairs only, positions may be 2D or 3D
+        return np.linalg.norm(
+            self.__positions[rows] - self.__positions[columns], axis=1
+            )
+
+    def __distance_moments(self, block=1024):
+        # Mean and std of all n x n distances from blocks of rows
+        total, total2 = 0.0, 0.0
+        for start in range(0, self.__cells, block):
+            D = cdist(self.__positions[start:start+block], self.__positions)
+            total += np.sum(D)
+            total2 += np.sum(D**2)
+        mean = total/self.__cells**2
+        return (mean, np.sqrt(max(total2/self.__cells**2 - mean**2, 0)))
+
+    def __neighbours(self, radius):
+        # Cells closer than radius from the spatial index, excluding cells
+        # at the same position, no distance is below a nonpositive radius
+        if radius <= 0:
+            return [np.array([], dtype="int") for i in range(self.__cells)]
+        tree = self.get_tree()
+        neighbours = []
+        for i, cells in enumerate(tree.query_ball_point(
+                self.__positions, np.nextafter(radius, 0), return_sorted=True
+                )):
+            cells = np.array(cells, dtype="int")
+            distances = self.__pair_distances(np.full(cells.size, i), cells)
+            neighbours.append(cells[distances != 0])
+        return neighbours
 
 # ------------------------------ GETTER METHODS ------------------------------
 
     def get_positions(self): return self.__positions
+
+    def get_distances(self):
+        # Dense distance matrix, computed once
+        if self.__distances is False:
+            self.__distances = squareform(pdist(self.__positions))
+        return self.__distances
+
+    def get_tree(self):
+        if self.__tree is False:
+            self.__tree = cKDTree(self.__positions)
+        return self.__tree
     def get_filtered_slow(self): return self.__filtered_slow
     def get_filtered_fast(self): return self.__filtered_fast
     def get_act_sig(self): return self.__act_sig
     def get_networks(self): return self.__networks
 
-    def get_parameters(self):
+    @instrumented("Analysis.get_parameters", __counts)
+    def get_parameters(self, restarts=1, seed=None, workers=1, mode="best"):
+        # Modularity options are passed to modularity, seed it for
+        # reproducible Q
         par_cell = [dict() for c in range(self.__cells)]
         par_network = False
         for cell in range(self.__cells):
@@ -112,8 +178,9 @@ class Analysis(object):
             par_network["Rf"] = self.average_correlation()[1]
             par_network["Ds"] = self.connection_distances()[0]
             par_network["Df"] = self.connection_distances()[1]
-            par_network["Qs"] = self.modularity()[0]
-            par_network["Qf"] = self.modularity()[1]
+            Q = self.modularity(restarts, seed, workers, mode)
+            par_network["Qs"] = Q[0]
+            par_network["Qf"] = Q[1]
             par_network["GEs"] = self.global_efficiency()[0]
             par_network["GEf"] = self.global_efficiency()[1]
             par_network["MCCs"] = self.max_connected_component()[0]
@@ -127,6 +194,8 @@ class Analysis(object):
                 par_cell[cell]["NNDs"] = self.nearest_neighbour_degree(cell)[0]
                 par_cell[cell]["NNDf"] = self.nearest_neighbour_degree(cell)[1]
 
+        return (par_cell, par_network)
+
 # ----------------------- INDIVIDUAL PARAMETER METHODS -----------------------
 
     def average_correlation(self):
@@ -134,43 +203,48 @@ class Analysis(object):
             raise ValueError("Network is not built.")
         return self.__networks.average_correlation()
 
+    @instrumented("Analysis.connection_distances", __counts)
     def connection_distances(self):
         if self.__networks is False:
             raise ValueError("Network is not built.")
-        A_dst = self.__distances_matrix()
         A_slow = self.__networks.get_A_slow()
         A_fast = self.__networks.get_A_fast()
 
-        A_dst_slow = np.multiply(A_dst, A_slow)
-        A_dst_fast = np.multiply(A_dst, A_fast)
+        # Distances of connected pairs ordered by the first and second cell
+        distances = []
+        for A in (A_slow, A_fast):
+            rows, columns = sparse.tril(A, -1, format="csr").nonzero()
+            d = self.__pair_distances(rows, columns)
+            distances.append(d[d > 0])
 
-        slow_distances, fast_distances = [], []
-        for c1 in range(self.__cells):
-            for c2 in range(c1):
-                ds = A_dst_slow[c1, c2]
-                df = A_dst_fast[c1, c2]
-                if ds > 0:
-                    slow_distances.append(ds)
-                if df > 0:
-                    fast_distances.append(df)
+        return tuple(distances)
 
-        return (np.array(slow_distances), np.array(fast_distances))
+    def modularity(self, restarts=1, seed=None, workers=1, mode="best"):
+        if self.__networks is False:
+            raise ValueError("Network is not built.")
+        return self.__networks.modularity(restarts, seed, workers, mode)
 
-    def modularity(self):
+    def global_efficiency(self, workers=1):
         if self.__networks is False:
             raise ValueError("Network is not built.")
-        return self.__networks.modularity()
+        return self.__networks.global_efficiency(workers)
 
-    def global_efficiency(self):
+    def sliding_networks(self, window, step=None, band="fast", ND_avg=None):
+        # Window and step in seconds, windows are labeled by their middle
         if self.__networks is False:
             raise ValueError("Network is not built.")
-        return self.__networks.global_efficiency()
+        window = int(window*self.__sampling)
+        step = window if step is None else int(step*self.__sampling)
+        results = self.__networks.sliding_networks(window, step, band, ND_avg)
+        results["time"] = (results["start"] + window/2)/self.__sampling
+        return results
 
     def max_connected_component(self):
         if self.__networks is False:
             raise ValueError("Network is not built.")
         return self.__networks.max_connected_component()
 
+    @instrumented("Analysis.amplitudes", __counts)
     def amplitudes(self):
         amplitudes = []
         for cell in range(self.__cells):
@@ -286,6 +360,7 @@ class Analysis(object):
 # ----------------------------- ANALYSIS METHODS ------------------------------
 # ----------------------------- Spikes vs phases ------------------------------
 
+    @instrumented("Analysis.spikes_vs_phase", __counts)
     def spikes_vs_phase(self, mode="normal"):
         phases = np.arange((np.pi/3 - np.pi/6)/2, 2*np.pi, np.pi/6)
         spikes = np.zeros((self.__cells, 12))
@@ -324,23 +399,23 @@ class Analysis(object):
 
 # ------------------------- Correlation vs distance ---------------------------
 
+    @instrumented("Analysis.correlation_vs_distance", __counts)
     def correlation_vs_distance(self):
-        A_dst = self.__distances_matrix()
-        distances = []
-        correlations_slow = []
-        correlations_fast = []
-        for cell1 in range(self.__cells):
-            for cell2 in range(cell1):
-                distances.append(A_dst[cell1, cell2])
-                corr_slow = np.corrcoef(self.__filtered_slow[cell1],
-                                        self.__filtered_slow[cell2])[0, 1]
-                corr_fast = np.corrcoef(self.__filtered_fast[cell1],
-                                        self.__filtered_fast[cell2])[0, 1]
-                correlations_slow.append(corr_slow)
-                correlations_fast.append(corr_fast)
-        return (distances, correlations_slow, correlations_fast)
+        # Correlations of built networks are reused, streamed networks keep
+        # none and all pairs are needed here
+        R_slow, R_fast = False, False
+        if self.__networks is not False:
+            R_slow = self.__networks.get_R_slow()
+            R_fast = self.__networks.get_R_fast()
+        if R_slow is False or R_fast is False:
+            R_slow = correlation_matrix(self.__filtered_slow)
+            R_fast = correlation_matrix(self.__filtered_fast)
+        # Pairs of cells ordered by the first and then the second cell
+        pairs = np.tril_indices(self.__cells, -1)
+        return (self.__pair_distances(*pairs), R_slow[pairs], R_fast[pairs])
 
 # -------------------------- WAVE DETECTION METHODS ---------------------------
+    @instrumented("Analysis.wave_detection", __events)
     def wave_detection(self, time_th=0.5):
         print("Detecting waves")
         event_num = []
@@ -348,12 +423,9 @@ class Analysis(object):
         bin_sig = self.__binarized_fast
         act_sig = np.zeros_like(bin_sig, int)
         frame_th = int(time_th*self.__sampling)
-        R = self.__distances_matrix()
-        R_th = np.average(R) - np.std(R)
-
-        neighbours = []
-        for i in range(self.__cells):
-            neighbours.append(np.where((R[i, :] < R_th) & (R[i, :] != 0))[0])
+        mean, std = self.__distance_moments()
+        R_th = mean - std
+        neighbours = self.__neighbours(R_th)
 
         nonzero = {}
         # Poisce vse frejme, kjer je kakšna celica aktivna
@@ -440,6 +512,7 @@ class Analysis(object):
                 counter += 1
         self.__act_sig = act_sig
 
+    @instrumented("Analysis.wave_characterization", __counts)
     def wave_characterization(self, big_th=0.45, small_th=0.1, time_th=0.5):
         if self.__act_sig is None:
             self.wave_detection(time_th)
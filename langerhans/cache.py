@@ -0,0 +1,87 @@
+import numpy as np
+
+import os
+import json
+import hashlib
+from pathlib import Path
+
+
+def signal_hash(signal, block=1024):
+    """
+    Returns a hex digest of the signal contents, shape and type. The signal
+    is hashed in blocks of rows so memory-mapped signals are not loaded.
+    """
+    h = hashlib.sha256()
+    h.update(str((signal.shape, signal.dtype.str)).encode())
+    for start in range(0, len(signal), block):
+        h.update(np.ascontiguousarray(signal[start:start+block]).tobytes())
+    return h.hexdigest()
+
+
+class StageCache(object):
+    """
+    Content-addressed on-disk cache of Data stage outputs. Each entry is an
+    .npz file of arrays, the least recently used entries are evicted when
+    the cache grows over max_size bytes.
+    """
+
+    def __init__(self, path, max_size=2**30):
+        self.__path = Path(path)
+        self.__path.mkdir(parents=True, exist_ok=True)
+        self.__max_size = max_size
+
+    def get_path(self): return self.__path
+    def get_max_size(self): return self.__max_size
+
+    def key(self, stage, signal, settings, keys, options=()):
+        # Only the settings sub-keys read by the stage enter the key
+        subset = {}
+        for path in keys:
+            value = settings
+            for k in path:
+                value = value[k]
+            subset["/".join(path)] = value
+        description = json.dumps(
+            [stage, signal, subset, list(options)], sort_keys=True,
+            default=str
+            )
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def load(self, key):
+        file = self.__path / "{0}.npz".format(key)
+        try:
+            with np.load(file) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+        except (OSError, ValueError):
+            return None
+        # Modification time orders entries for eviction
+        os.utime(file)
+        return arrays
+
+    def store(self, key, arrays):
+        file = self.__path / "{0}.npz".format(key)
+        # Temporary files are named per process and not matched by eviction,
+        # so processes sharing the cache do not remove each other's writes
+        temporary = self.__path / "{0}.{1}.tmp".format(key, os.getpid())
+        with open(temporary, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(temporary, file)
+        self.evict()
+
+    def size(self):
+        return sum(f.stat().st_size for f in self.__path.glob("*.npz"))
+
+    def evict(self, max_size=None):
+        max_size = self.__max_size if max_size is None else max_size
+        files = [(f.stat().st_mtime, f.stat().st_size, f)
+                 for f in self.__path.glob("*.npz")
+                 ]
+        total = sum(size for _, size, _ in files)
+        for _, size, f in sorted(files, key=lambda x: x[0]):
+            if total <= max_size:
+                break
+            f.unlink()
+            total -= size
+
+    def clear(self):
+        self.evict(0)
@@ -1,6 +1,11 @@
 import numpy as np
+import copy
+import warnings
+import tempfile
+from pathlib import Path
 
-from scipy.signal import butter, sosfiltfilt
+from scipy.signal import butter, sosfiltfilt, sosfreqz
+from scipy.fft import rfft, irfft, next_fast_len
 from scipy.stats import skew, skewnorm, norm
 from scipy.optimize import curve_fit, differential_evolution
 
@@ -10,6 +15,9 @@ import matplotlib.transforms as transforms
 import matplotlib.patches as patches
 from matplotlib.gridspec import GridSpec
 
+from .cache import signal_hash
+from .instrumentation import instrumented
+
 EXCLUDE_COLOR = 'xkcd:salmon'
 SAMPLE_SETTINGS = {
     "Glucose [mM]": 8,
@@ -30,8 +38,39 @@ SAMPLE_SETTINGS = {
     "Distance [um]": 1
     }
 STD_RATIO = 2
+# Recordings shorter than this many band time constants warn in FFT filtering
+FFT_DURATION_RATIO = 20
+# Stages with the earlier stages and the settings sub-keys they read
+STAGES = {
+    "filtered_slow": ((), (("Sampling [Hz]",), ("Filter", "Slow [Hz]"))),
+    "filtered_fast": ((), (("Sampling [Hz]",), ("Filter", "Fast [Hz]"))),
+    "distributions": (("filtered_fast",), (("Stimulation [frame]",),)),
+    "binarized_slow": (("filtered_slow",), ()),
+    "binarized_fast": (("filtered_fast", "distributions"), ()),
+    "activity": (("binarized_fast",), (("Sampling [Hz]",),))
+    }
+
+
+def stage_settings(stage):
+    dependencies, keys = STAGES[stage]
+    keys = set(keys)
+    for dependency in dependencies:
+        keys.update(stage_settings(dependency))
+    return tuple(sorted(keys))
+
+
+# Settings sub-keys read by each stage including its earlier stages
+STAGE_SETTINGS = {stage: stage_settings(stage) for stage in STAGES}
 
 
+def merge_settings(old, new):
+    # Updates nested settings in place with the values given in new
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(old.get(key), dict):
+            merge_settings(old[key], value)
+        else:
+            old[key] = copy.deepcopy(value)
+
 class Data(object):
     """
     A class for signal analysis.
@@ -47,28 +86,118 @@ class Data(object):
         self.__cells = False
         self.__filtered_slow = False
         self.__filtered_fast = False
+        self.__filtered_bank = False
         self.__distributions = False
         self.__binarized_slow = False
         self.__binarized_fast = False
         self.__activity = False
         self.__good_cells = False
 
+        self.__chunk = None
+        self.__cache = False
+        self.__signal_hash = False
+        self.__filter_mode = "sos"
+        self.__autolimit_mode = "evolution"
+
+        # Exclusions are recomputed from the stages they depend on
+        self.__requested = set()
+        self.__autoexclude = False
+        self.__spikes = False
+        self.__unexcluded = False
+
+        # Decimated traces for plotting, keyed by trace, cell and pixel width
+        self.__traces = {}
+
+    def __counts(self, result=None):
+        return {"cells": self.__cells, "points": self.__points}
+
+    def __setstate__(self, state):
+        # Data pickled by earlier versions lacks later attributes and keeps
+        # stages in their old formats, its good cells already hold all
+        # automatic exclusions
+        self.__dict__.update(Data().__dict__)
+        self.__dict__.update(state)
+        if self.__good_cells is not False and self.__unexcluded is False:
+            self.__unexcluded = np.zeros(self.__cells, dtype="bool")
+        if isinstance(self.__distributions, list):
+            # Parameters of the normalized filtered signal, which was
+            # normalized in place
+            self.__distributions = {
+                "norm": np.ones(self.__cells),
+                "noise_params": np.array(
+                    [d["noise_params"] for d in self.__distributions]
+                    ),
+                "spikes_params": np.array(
+                    [d["spikes_params"] for d in self.__distributions]
+                    )
+                }
+        if self.__binarized_fast is not False and \
+                self.__binarized_fast.dtype != np.uint8:
+            binarized = self.__binarized_fast.astype(bool)
+            self.__spikes = np.sum(binarized, axis=1)
+            self.__binarized_fast = np.packbits(binarized, axis=1)
+        if self.__binarized_slow is not False:
+            self.__binarized_slow = self.__binarized_slow.astype(np.uint8)
+
 # --------------------------------- IMPORTS -----------------------------------
+    @instrumented("Data.import_data", __counts)
     def import_data(self, signal):
         if not len(signal.shape) == 2:
             raise ValueError("Signal shape not 2D.")
-        self.__signal = np.around(signal[:, 1:].transpose(), decimals=3)
-        self.__mean_islet = np.mean(self.__signal, 0)  # average over 0 axis
-        self.__mean_islet = self.__mean_islet - np.mean(self.__mean_islet)
+        signal = np.around(signal[:, 1:].transpose(), decimals=3)
+        self.__chunk = None
+        self.__import_signal(signal, np.mean(signal, 0))  # average over cells
+
+    @instrumented("Data.import_file", __counts)
+    def import_file(self, path, columns=None, dtype="float64", chunk=None):
+        path = Path(path)
+        if path.suffix == ".npy":
+            signal = np.load(path, mmap_mode="r")
+        elif columns is None:
+            raise ValueError("Number of columns of raw file not given.")
+        else:
+            signal = np.memmap(path, dtype=dtype, mode="r").reshape(
+                -1, columns
+                )
+        if not len(signal.shape) == 2:
+            raise ValueError("Signal shape not 2D.")
+
+        # One pass over blocks of contiguous rows of the file computes the
+        # mean over cells and writes a cell-major copy to a temporary memory
+        # map, so later stages read blocks of cells without touching every
+        # page of the time-major file
+        points, cells = len(signal), signal.shape[1] - 1
+        block = max(int(2**24/signal.shape[1]), 1)
+        mean_islet = np.empty(points)
+        cell_major = np.memmap(tempfile.TemporaryFile(), dtype=signal.dtype,
+                               mode="w+", shape=(cells, points)
+                               )
+        for start in range(0, points, block):
+            stop = min(start + block, points)
+            rows = np.asarray(signal[start:stop, 1:])
+            mean_islet[start:stop] = np.mean(rows, axis=1)
+            cell_major[:, start:stop] = rows.transpose()
+        cell_major.flush()
+
+        self.__chunk = chunk
+        self.__import_signal(cell_major, mean_islet)
+
+    def import_cache(self, cache):
+        self.__cache = cache
+
+    def __import_signal(self, signal, mean_islet):
+        self.__signal = signal
+        self.__signal_hash = False
+        self.__mean_islet = mean_islet - np.mean(mean_islet)
         if self.__settings is False:
-            self.__settings = SAMPLE_SETTINGS
+            self.__settings = copy.deepcopy(SAMPLE_SETTINGS)
         sampling = self.__settings["Sampling [Hz]"]
         self.__time = np.arange(len(self.__signal[0]))*(1/sampling)
 
         self.__points = len(self.__time)
         self.__cells = len(self.__signal)
 
-        self.__good_cells = np.ones(self.__cells, dtype="bool")
+        self.reset_computations()
 
     def import_settings(self, settings=SAMPLE_SETTINGS):
         if "Sampling [Hz]" not in settings and \
@@ -84,23 +213,100 @@ class Data(object):
         if "Score threshold" not in settings["Exclude"] and \
                 "Spikes threshold" not in settings["Exclude"]:
             raise ValueError("Bad keys in settings[exclude].")
-        self.__settings = settings
+        old_settings = self.__settings
+        # A copy, so settings edited in place by callers are still compared
+        self.__settings = copy.deepcopy(settings)
+        if old_settings is not False and self.__signal is not False:
+            self.__invalidate_settings(old_settings, settings)
+
+    def update_settings(self, settings):
+        if self.__settings is False:
+            self.__settings = copy.deepcopy(SAMPLE_SETTINGS)
+        updated = copy.deepcopy(self.__settings)
+        merge_settings(updated, settings)
+        self.import_settings(updated)
 
     def import_good_cells(self, cells):
         if self.__signal is False:
             raise ValueError("No imported data!")
         if len(cells) != self.__cells:
             raise ValueError("Cell number does not match.")
-        self.__good_cells = cells
+        self.__good_cells = np.array(cells, dtype="bool")
+        self.__unexcluded = np.zeros(self.__cells, dtype="bool")
 
     def reset_computations(self):
-        self.__filtered_slow = False
-        self.__filtered_fast = False
-        self.__distributions = False
-        self.__binarized_slow = False
-        self.__binarized_fast = False
-        self.__activity = False
+        for stage in STAGES:
+            self.__invalidate(stage)
+        self.__filtered_bank = False
+        self.__requested = set()
+        self.__autoexclude = False
         self.__good_cells = np.ones(self.__cells, dtype="bool")
+        self.__unexcluded = np.zeros(self.__cells, dtype="bool")
+
+# ---------------------------- STAGE DEPENDENCIES -----------------------------
+
+    def __stage(self, stage):
+        # Results are stored in attributes named after their stages
+        return getattr(self, "_Data__" + stage)
+
+    def __invalidate(self, stage):
+        setattr(self, "_Data__" + stage, False)
+        self.__traces = {}
+        if stage == "binarized_fast":
+            self.__spikes = False
+        for later, (dependencies, _) in STAGES.items():
+            if stage in dependencies:
+                self.__invalidate(later)
+
+    def __invalidate_settings(self, old, new):
+        changed = list(self.__changed(old, new))
+        for stage, (_, keys) in STAGES.items():
+            for path in changed:
+                if any(path[:len(k)] == k or k[:len(path)] == path
+                       for k in keys
+                       ):
+                    self.__invalidate(stage)
+                    break
+        # The filter bank reads the sampling and all filter bands
+        if any(path[:1] in (("Sampling [Hz]",), ("Filter",))
+               for path in changed
+               ):
+            self.__filtered_bank = False
+        if ("Sampling [Hz]",) in changed:
+            sampling = self.__settings["Sampling [Hz]"]
+            self.__time = np.arange(self.__points)*(1/sampling)
+
+    def __changed(self, old, new, path=()):
+        # Paths of the settings values that differ
+        if isinstance(old, dict) and isinstance(new, dict):
+            for key in set(old).union(new):
+                yield from self.__changed(old.get(key), new.get(key),
+                                          path + (key,)
+                                          )
+        elif old != new:
+            yield path
+
+    def __require(self, stage):
+        if self.__signal is False:
+            raise ValueError("No imported data!")
+        if self.__stage(stage) is not False:
+            return
+        if stage in ("filtered_slow", "filtered_fast"):
+            self.__filter((stage,))
+        elif stage == "distributions":
+            self.compute_distributions()
+        elif stage == "binarized_slow":
+            self.binarize_slow()
+        elif stage == "binarized_fast":
+            self.binarize_fast()
+        elif stage == "activity":
+            self.autolimit(self.__autolimit_mode)
+
+    def __lazy(self, stage):
+        if self.__signal is False:
+            return False
+        self.__require(stage)
+        return self.__stage(stage)
 
 # --------------------------------- GETTERS -----------------------------------
 
@@ -110,55 +316,114 @@ class Data(object):
     def get_mean_islet(self): return self.__mean_islet
     def get_points(self): return self.__points
     def get_cells(self): return self.__cells
-    def get_filtered_slow(self): return self.__filtered_slow
-    def get_filtered_fast(self): return self.__filtered_fast
-    def get_distributions(self): return self.__distributions
-    def get_binarized_slow(self): return self.__binarized_slow
-    def get_binarized_fast(self): return self.__binarized_fast
-    def get_activity(self): return self.__activity
-    def get_good_cells(self): return self.__good_cells
+    def get_filtered_slow(self): return self.__lazy("filtered_slow")
+    def get_filtered_fast(self): return self.__lazy("filtered_fast")
+    def get_filtered_bank(self): return self.__filtered_bank
+
+    def get_filtered_band(self, band):
+        if self.__filtered_bank is False:
+            raise ValueError("No filter bank data!")
+        if band not in self.__filtered_bank:
+            raise ValueError("Band not in filter bank.")
+        return self.__filtered_bank[band]
+    def get_distributions(self): return self.__lazy("distributions")
+    def get_binarized_fast_packed(self): return self.__lazy("binarized_fast")
+
+    def get_binarized_slow(self, cells=None):
+        binarized_slow = self.__lazy("binarized_slow")
+        if binarized_slow is False or cells is None:
+            return binarized_slow
+        return binarized_slow[cells]
+
+    def get_binarized_fast(self, cells=None):
+        packed = self.__lazy("binarized_fast")
+        if packed is False:
+            return False
+        # Spikes are stored bit-packed along time and unpacked on demand
+        if cells is not None:
+            packed = packed[cells]
+        return np.unpackbits(packed, axis=-1, count=self.__points)
+    def get_activity(self): return self.__lazy("activity")
+
+    def get_good_cells(self):
+        if self.__signal is False:
+            return self.__good_cells
+        good_cells = self.__good_cells.copy()
+        if self.__autoexclude:
+            self.__require("distributions")
+            good_cells[self.__score_excluded()] = False
+        if "binarized_fast" in self.__requested:
+            self.__require("binarized_fast")
+            spikes_th = self.__settings["Exclude"]["Spikes threshold"]
+            good_cells[self.__spikes < spikes_th*self.__points] = False
+        if "activity" in self.__requested:
+            self.__require("activity")
+            sampling = self.__settings["Sampling [Hz]"]
+            stimulation = self.__settings["Stimulation [frame]"][0]
+            good_cells[self.__activity[:, 0] < stimulation/sampling] = False
+        good_cells[self.__unexcluded] = True
+        return good_cells
 
     def plot(self, ax, cell,
-             plots=("mean", "raw", "slow", "fast"), protocol=True
+             plots=("mean", "raw", "slow", "fast"), protocol=True, lod=True,
+             xlim=None
              ):
         time = self.__time
+        xlim = (0, self.__time[-1]) if xlim is None else tuple(xlim)
         sampling = self.__settings["Sampling [Hz]"]
         glucose = self.__settings["Glucose [mM]"]
         TA, TAE = self.__settings["Stimulation [frame]"]
         TA, TAE = TA/sampling, TAE/sampling
 
         if "mean" in plots:
-            signal = self.__mean_islet
-            signal = signal/np.max(signal)
-            ax.plot(time, signal, "k", alpha=0.25, lw=0.1)
+            def signal():
+                return self.__mean_islet/np.max(self.__mean_islet)
+            ax.plot(*self.__trace(ax, "mean", None, signal, lod, xlim),
+                    "k", alpha=0.25, lw=0.1
+                    )
         if "raw" in plots:
-            signal = self.__signal[cell]
-            signal = signal - np.mean(signal)
-            signal = signal/np.max(signal)
-            ax.plot(time, signal, "k", alpha=0.5, lw=0.1)
+            def signal():
+                signal = self.__signal[cell]
+                signal = signal - np.mean(signal)
+                return signal/np.max(signal)
+            ax.plot(*self.__trace(ax, "raw", cell, signal, lod, xlim),
+                    "k", alpha=0.5, lw=0.1
+                    )
         if "slow" in plots:
-            filtered_slow = self.__filtered_slow[cell]
-            filtered_slow = filtered_slow/np.max(filtered_slow)
-            ax.plot(time, filtered_slow, color="C0", lw=2)
+            def signal():
+                filtered_slow = self.get_filtered_slow()[cell]
+                return filtered_slow/np.max(filtered_slow)
+            ax.plot(*self.__trace(ax, "slow", cell, signal, lod, xlim),
+                    color="C0", lw=2
+                    )
         if "fast" in plots:
-            filtered_fast = self.__filtered_fast[cell]
-            filtered_fast = filtered_fast/np.max(filtered_fast)
-            ax.plot(time, filtered_fast, color="C3", lw=0.2)
+            def signal():
+                filtered_fast = self.get_filtered_fast()[cell]
+                return filtered_fast/np.max(filtered_fast)
+            ax.plot(*self.__trace(ax, "fast", cell, signal, lod, xlim),
+                    color="C3", lw=0.2
+                    )
         if "bin_slow" in plots:
-            binarized_slow = self.__binarized_slow[cell]
+            def signal():
+                return self.get_binarized_slow(cell)
             ax2 = ax.twinx()
-            ax2.plot(time, binarized_slow, color="k", lw=1)
+            ax2.plot(*self.__trace(ax, "bin_slow", cell, signal, lod, xlim),
+                     color="k", lw=1
+                     )
             ax2.set_ylabel("Phase")
         if "bin_fast" in plots:
-            # threshold = self.__distributions[cell]["noise_params"][2]
-            filtered_fast = self.__filtered_fast[cell]
-            binarized_fast = self.__binarized_fast[cell]/np.max(filtered_fast)
-            binarized_fast *= 0.5  # *=threshold
-            ax.plot(time, binarized_fast, color="k", lw=1)
+            def signal():
+                # threshold = self.__distributions["noise_params"][cell, 2]
+                filtered_fast = self.get_filtered_fast()[cell]
+                binarized_fast = self.get_binarized_fast(cell)
+                return 0.5*binarized_fast/np.max(filtered_fast)  # *threshold
+            ax.plot(*self.__trace(ax, "bin_fast", cell, signal, lod, xlim),
+                    color="k", lw=1
+                    )
             ax2 = ax.twinx()
             ax2.set_ylabel("Action potentials")
 
-        ax.set_xlim(0, self.__time[-1])
+        ax.set_xlim(*xlim)
         ax.set_ylim(None, 1.1)
         ax.set_xlabel("Time [s]")
         ax.set_ylabel("Amplitude")
@@ -169,7 +434,7 @@ class Data(object):
         ax.axvline(frame_start/sampling, c="grey")
         ax.axvline(frame_end/sampling, c="grey")
 
-        if self.__good_cells[cell]:
+        if self.get_good_cells()[cell]:
             if self.__activity is not False:
                 border = self.__activity[cell]
                 ax.axvspan(0, border[0], alpha=0.25, color="grey")
@@ -210,6 +475,48 @@ class Data(object):
                             annotation_clip=False
                             )
 
+    def __trace(self, ax, name, cell, signal, lod=True, xlim=None):
+        if not lod:
+            return (self.__time, signal())
+        # Only the visible frames are decimated, with one frame beyond each
+        # side, so zoomed axes keep their detail
+        start, stop = 0, self.__points
+        if xlim is not None:
+            start = max(np.searchsorted(self.__time, xlim[0]) - 1, 0)
+            stop = min(np.searchsorted(self.__time, xlim[1], "right") + 1,
+                       self.__points
+                       )
+        # One minimum and one maximum per horizontal pixel of the axis
+        width = max(int(np.ceil(ax.get_window_extent().width)), 1)
+        key = (name, cell, width, start, stop)
+        if key not in self.__traces:
+            self.__traces[key] = self.__decimate(
+                signal()[start:stop], width, start
+                )
+        return self.__traces[key]
+
+    def __decimate(self, signal, width, start=0):
+        points = len(signal)
+        time = self.__time[start:start+points]
+        if points <= 2*width:
+            return (time, signal)
+        bucket = int(np.ceil(points/width))
+        buckets = int(np.ceil(points/bucket))
+        # Last bucket is padded with the last sample
+        padded = np.empty(buckets*bucket, signal.dtype)
+        padded[:points] = signal
+        padded[points:] = signal[-1]
+        padded = padded.reshape(buckets, bucket)
+
+        offsets = np.arange(buckets)*bucket
+        minima = np.minimum(offsets + np.argmin(padded, axis=1), points-1)
+        maxima = np.minimum(offsets + np.argmax(padded, axis=1), points-1)
+        # Extremes of each bucket are kept in time order
+        indices = np.column_stack((np.minimum(minima, maxima),
+                                   np.maximum(minima, maxima)
+                                   )).ravel()
+        return (time[indices], signal[indices])
+
 # ----------------------------- ANALYSIS METHODS ------------------------------
 
     def plot_raw(self, i):
@@ -226,35 +533,171 @@ class Data(object):
 
 # ---------- Filter + smooth ---------- #
 
-    def filter(self):
+    def filter(self, chunk=None, mode="sos"):
         if self.__signal is False:
             raise ValueError("No imported data!")
-        slow = self.__settings["Filter"]["Slow [Hz]"]
-        fast = self.__settings["Filter"]["Fast [Hz]"]
-        self.__filtered_slow = np.zeros((self.__cells, self.__points))
-        self.__filtered_fast = np.zeros((self.__cells, self.__points))
-
-        for i in range(self.__cells):
-            self.__filtered_slow[i] = self.__bandpass(self.__signal[i],
-                                                      (*slow)
-                                                      )
-            self.__filtered_fast[i] = self.__bandpass(self.__signal[i],
-                                                      (*fast)
-                                                      )
-
-    def __bandpass(self, data, lowcut, highcut, order=5):
+        if mode not in ("sos", "fft"):
+            raise ValueError("Unknown filter mode.")
+        if mode != self.__filter_mode:
+            self.__invalidate("filtered_slow")
+            self.__invalidate("filtered_fast")
+            self.__filter_mode = mode
+        self.__filter(("filtered_slow", "filtered_fast"), chunk)
+
+    @instrumented("Data.filter", __counts)
+    def __filter(self, stages, chunk=None):
+        settings = {
+            "filtered_slow": self.__settings["Filter"]["Slow [Hz]"],
+            "filtered_fast": self.__settings["Filter"]["Fast [Hz]"]
+            }
+        bands = {stage: settings[stage] for stage in stages}
+
+        filtered = {}
+        for stage in bands:
+            arrays = self.__load(stage)
+            if arrays is not None:
+                filtered[stage] = arrays["filtered"]
+        missing = {s: bands[s] for s in bands if s not in filtered}
+
+        if self.__filter_mode == "fft":
+            # Missing bands share one spectrum per cell
+            computed = self.__fft_bank(missing, chunk) if missing else {}
+        else:
+            # Each filter is designed once and applied to blocks of cells
+            computed = {}
+            for stage, (lowcut, highcut) in missing.items():
+                computed[stage] = np.empty((self.__cells, self.__points))
+                self.__bandpass(self.__signal, lowcut, highcut,
+                                out=computed[stage], chunk=chunk
+                                )
+        for stage in computed:
+            self.__store(stage, {"filtered": computed[stage]})
+        filtered.update(computed)
+
+        if "filtered_slow" in filtered:
+            self.__filtered_slow = filtered["filtered_slow"]
+        if "filtered_fast" in filtered:
+            self.__filtered_fast = filtered["filtered_fast"]
+        self.__requested.update(stages)
+
+    @instrumented("Data.filter_bank", __counts)
+    def filter_bank(self, bands=None, chunk=None):
+        if self.__signal is False:
+            raise ValueError("No imported data!")
+        if bands is None:
+            bands = {
+                "Slow [Hz]": self.__settings["Filter"]["Slow [Hz]"],
+                "Fast [Hz]": self.__settings["Filter"]["Fast [Hz]"]
+                }
+            bands.update(self.__settings["Filter"].get("Bank [Hz]", {}))
+        self.__filtered_bank = self.__fft_bank(bands, chunk)
+
+    def __fft_bank(self, bands, chunk=None, order=5):
+        # The FFT response equals sosfiltfilt only for recordings much longer
+        # than the time constant of a band, otherwise the symmetric extension
+        # and sosfiltfilt's padding and transients differ over the whole
+        # recording, not just near the edges
+        duration = self.__points/self.__settings["Sampling [Hz]"]
+        for lowcut, highcut in bands.values():
+            if duration < FFT_DURATION_RATIO/lowcut:
+                warnings.warn(
+                    "Recording of {0:.0f} s is short for FFT filtering of "
+                    "the {1:g}-{2:g} Hz band with time constant {3:.0f} s, "
+                    "use mode 'sos'.".format(duration, lowcut, highcut,
+                                             1/lowcut
+                                             ),
+                    RuntimeWarning
+                    )
+
+        # Symmetric extension removes the wrap-around jump of the FFT
+        length = next_fast_len(2*self.__points, real=True)
+        frequencies = np.fft.rfftfreq(length, 1/self.__settings["Sampling [Hz]"])
+
+        # Squared Butterworth magnitude is the zero-phase (filtfilt) response
+        masks = {}
+        for band, (lowcut, highcut) in bands.items():
+            sos = self.__sos(lowcut, highcut, order)
+            _, h = sosfreqz(sos, worN=frequencies,
+                            fs=self.__settings["Sampling [Hz]"]
+                            )
+            masks[band] = np.abs(h)**2
+        bank = {band: np.empty((self.__cells, self.__points)) for band in bands}
+
+        # One spectrum per cell is shared by all bands. The band-pass removes
+        # the mean anyway, without it zero padding adds no step to the signal
+        for start, stop in self.__blocks(chunk):
+            block = self.__signal[start:stop]
+            block = block - np.mean(block, axis=1, keepdims=True)
+            spectrum = rfft(np.concatenate((block, block[:, ::-1]), axis=1),
+                            n=length, axis=1
+                            )
+            for band in bands:
+                bank[band][start:stop] = irfft(
+                    spectrum*masks[band], n=length, axis=1
+                    )[:, :self.__points]
+        return bank
+
+    def __hash(self):
+        if self.__signal_hash is False:
+            self.__signal_hash = signal_hash(self.__signal)
+        return self.__signal_hash
+
+    def __key(self, stage, options):
+        # Every stage depends on how the signal was filtered
+        return self.__cache.key(
+            stage, self.__hash(), self.__settings, STAGE_SETTINGS[stage],
+            (self.__filter_mode,) + options
+            )
+
+    def __load(self, stage, *options):
+        if self.__cache is False:
+            return None
+        return self.__cache.load(self.__key(stage, options))
+
+    def __store(self, stage, arrays, *options):
+        if self.__cache is False:
+            return
+        self.__cache.store(self.__key(stage, options), arrays)
+
+    def __cached(self, stage, compute, *options):
+        arrays = self.__load(stage, *options)
+        if arrays is None:
+            arrays = compute()
+            self.__store(stage, arrays, *options)
+        return arrays
+
+    def __blocks(self, chunk=None):
+        # Ranges of cells processed at once, all cells by default
+        chunk = self.__chunk if chunk is None else chunk
+        chunk = self.__cells if chunk is None else max(int(chunk), 1)
+        for start in range(0, self.__cells, chunk):
+            yield (start, min(start + chunk, self.__cells))
+
+    def __sos(self, lowcut, highcut, order=5):
         nyq = 0.5*self.__settings["Sampling [Hz]"]
         low = lowcut / nyq
         high = highcut / nyq
-        sos = butter(
+        return butter(
             order, [low, high], analog=False, btype='band', output='sos'
             )
-        y = sosfiltfilt(sos, data)
-        return y
+
+    def __bandpass(self, data, lowcut, highcut, order=5, out=None,
+                   chunk=None
+                   ):
+        sos = self.__sos(lowcut, highcut, order)
+        if out is None:
+            out = np.empty(data.shape)
+        if data.ndim == 1:
+            out[:] = sosfiltfilt(sos, data)
+            return out
+        # Filter whole blocks of cells along the time axis
+        for start, stop in self.__blocks(chunk):
+            out[start:stop] = sosfiltfilt(sos, data[start:stop], axis=1)
+        return out
 
     def plot_filtered(self, i):
-        if self.__filtered_slow is False or self.__filtered_fast is False:
-            raise ValueError("No filtered data!")
+        self.__require("filtered_slow")
+        self.__require("filtered_fast")
         if i not in range(self.__cells):
             raise ValueError("Cell index not in range.")
 
@@ -264,46 +707,67 @@ class Data(object):
         self.plot(ax1, i, plots=("raw, slow"))
         ax1.set_xlabel(None)
 
-        self.plot(ax2, i, plots=("raw, fast"), protocol=False)
-        ax2.set_xlim(*self.__settings["Filter"]["Plot [s]"])
+        self.plot(ax2, i, plots=("raw, fast"), protocol=False,
+                  xlim=self.__settings["Filter"]["Plot [s]"]
+                  )
 
         return fig
 
 # ---------- Distributions ---------- #
 
-    def compute_distributions(self):
-        if self.__filtered_slow is False:
-            raise ValueError("No filtered data.")
-        self.__distributions = [dict() for i in range(self.__cells)]
-
-        for cell in range(self.__cells):
-            signal = self.__filtered_fast[cell]
-            signal /= np.max(np.abs(signal))
-
-            # Define noise from time 0 to start of stimulation
-            stimulation = int(self.__settings["Stimulation [frame]"][0])
-            noise = signal[:int(stimulation)]
-            spikes = signal[int(stimulation):]
-
-            # Distribution parameters of noise
-            noise_params = (skew(noise), np.mean(noise), np.std(noise))
-            spikes_params = (skew(spikes), np.mean(spikes), np.std(spikes))
-
-            self.__distributions[cell]["noise_params"] = noise_params
-            self.__distributions[cell]["spikes_params"] = spikes_params
-            self.__distributions[cell]["noise_hist"] = np.histogram(noise, 20)
-            self.__distributions[cell]["spikes_hist"] = np.histogram(
-                spikes, 100
-                )
+    @instrumented("Data.compute_distributions", __counts)
+    def compute_distributions(self, chunk=None):
+        self.__require("filtered_fast")
+        self.__distributions = self.__cached(
+            "distributions", lambda: self.__distributions_all(chunk)
+            )
+        self.__requested.add("distributions")
+
+    def __distributions_all(self, chunk=None):
+        # Define noise from time 0 to start of stimulation
+        stimulation = int(self.__settings["Stimulation [frame]"][0])
+
+        # Normalization is kept as a factor, the filtered data is untouched
+        norm = np.empty(self.__cells)
+        noise_params = np.empty((self.__cells, 3))
+        spikes_params = np.empty((self.__cells, 3))
+        for start, stop in self.__blocks(chunk):
+            signal = self.__filtered_fast[start:stop]
+            norm[start:stop] = np.max(np.abs(signal), axis=1)
+            noise = signal[:, :stimulation]
+            spikes = signal[:, stimulation:]
+
+            # Distribution parameters of cells, skewness is scale invariant
+            noise_params[start:stop] = np.column_stack((
+                skew(noise, axis=1),
+                np.mean(noise, axis=1)/norm[start:stop],
+                np.std(noise, axis=1)/norm[start:stop]
+                ))
+            spikes_params[start:stop] = np.column_stack((
+                skew(spikes, axis=1),
+                np.mean(spikes, axis=1)/norm[start:stop],
+                np.std(spikes, axis=1)/norm[start:stop]
+                ))
+
+        return {
+            "norm": norm,
+            "noise_params": noise_params,
+            "spikes_params": spikes_params
+            }
+
+    def __histograms(self, cell):
+        signal = self.__filtered_fast[cell]/self.__distributions["norm"][cell]
+        stimulation = int(self.__settings["Stimulation [frame]"][0])
+        noise_hist = np.histogram(signal[:stimulation], 20)
+        spikes_hist = np.histogram(signal[stimulation:], 100)
+        return (noise_hist, spikes_hist)
 
     def plot_distributions(self, i):
-        if self.__distributions is False:
-            raise ValueError("No distribution data.")
+        self.__require("distributions")
 
-        noise_params = self.__distributions[i]["noise_params"]
-        spikes_params = self.__distributions[i]["spikes_params"]
-        noise_h, noise_bins = self.__distributions[i]["noise_hist"]
-        spikes_h, spikes_bins = self.__distributions[i]["spikes_hist"]
+        noise_params = self.__distributions["noise_params"][i]
+        spikes_params = self.__distributions["spikes_params"][i]
+        (noise_h, noise_bins), (spikes_h, spikes_bins) = self.__histograms(i)
 
         fig = plt.figure(constrained_layout=True)
         gs = GridSpec(2, 2, figure=fig)
@@ -341,128 +805,237 @@ class Data(object):
         return fig
 
 # ---------- Exclude ---------- #
+    @instrumented("Data.autoexclude", __counts)
     def autoexclude(self):
-        if self.__distributions is False:
-            raise ValueError("No distributions.")
+        self.__require("distributions")
+        self.__autoexclude = True
+        good_cells = self.get_good_cells()
+        print("{} of {} good cells ({:0.0f}%)".format(
+            np.sum(good_cells), self.__cells,
+            np.sum(good_cells)/self.__cells*100)
+            )
+
+    def __score_excluded(self):
         # Excluding thresholds
         score_threshold = self.__settings["Exclude"]["Score threshold"]
 
-        for cell in range(self.__cells):
-            skew = self.__distributions[cell]["spikes_params"][0]
-            noise_std = self.__distributions[cell]["noise_params"][2]
-            spikes_std = self.__distributions[cell]["spikes_params"][2]
-            if skew < score_threshold and spikes_std < STD_RATIO*noise_std:
-                self.__good_cells[cell] = False
-        print("{} of {} good cells ({:0.0f}%)".format(
-            np.sum(self.__good_cells), self.__cells,
-            np.sum(self.__good_cells)/self.__cells*100)
-            )
+        skewness = self.__distributions["spikes_params"][:, 0]
+        noise_std = self.__distributions["noise_params"][:, 2]
+        spikes_std = self.__distributions["spikes_params"][:, 2]
+        excluded = np.logical_and(skewness < score_threshold,
+                                  spikes_std < STD_RATIO*noise_std
+                                  )
+        return excluded
 
     def exclude(self, i):
         if i not in range(self.__cells):
             raise ValueError("Cell not in range.")
         self.__good_cells[i] = False
+        self.__unexcluded[i] = False
 
     def unexclude(self, i):
         if i not in range(self.__cells):
             raise ValueError("Cell not in range.")
+        # Manually included cells override automatic exclusions
         self.__good_cells[i] = True
+        self.__unexcluded[i] = True
 
 # ---------- Binarize ---------- #
 
-    def __search_sequence(self, arr, seq):
-        # Store sizes of input array and sequence
-        seq = np.array(seq)
-        Na, Nseq = arr.size, seq.size
-
-        # Range of sequence
-        r_seq = np.arange(Nseq)
+    @instrumented("Data.binarize_fast", __counts)
+    def binarize_fast(self, chunk=None):
+        self.__require("filtered_fast")
+        self.__require("distributions")
+        arrays = self.__cached(
+            "binarized_fast", lambda: self.__binarized_fast_all(chunk)
+            )
+        # Spike counts exclude cells against the current spikes threshold
+        self.__binarized_fast = arrays["binarized"]
+        self.__spikes = arrays["spikes"]
+        self.__requested.add("binarized_fast")
+
+    def __binarized_fast_all(self, chunk=None):
+        # Threshold of the normalized signal in units of filtered data
+        threshold = 3*self.__distributions["noise_params"][:, 2]
+        threshold *= self.__distributions["norm"]
+
+        binarized_fast = np.zeros(
+            (self.__cells, (self.__points+7)//8), np.uint8
+            )
+        spikes = np.zeros(self.__cells, int)
+        for start, stop in self.__blocks(chunk):
+            binarized = self.__filtered_fast[start:stop] > \
+                threshold[start:stop, np.newaxis]
+            spikes[start:stop] = np.sum(binarized, axis=1)
+            binarized_fast[start:stop] = np.packbits(binarized, axis=1)
+        return {"binarized": binarized_fast, "spikes": spikes}
+
+    @instrumented("Data.binarize_slow", __counts)
+    def binarize_slow(self, chunk=None):
+        self.__require("filtered_slow")
+        self.__binarized_slow = self.__cached(
+            "binarized_slow", lambda: self.__binarized_slow_all(chunk)
+            )["binarized"]
+        self.__requested.add("binarized_slow")
+
+    def __binarized_slow_all(self, chunk=None):
+        binarized_slow = np.zeros((self.__cells, self.__points), np.uint8)
+        for start, stop in self.__blocks(chunk):
+            binarized_slow[start:stop] = self.__phases(
+                self.__filtered_slow[start:stop]
+                )
+        return {"binarized": binarized_slow}
+
+    def __phases(self, signal):
+        # Gradient changes sign from - to + at minima and from + to - at maxima
+        rising = np.gradient(signal, axis=1) > 0
+        change = np.diff(rising.astype(np.int8), axis=1)
+        cells, extremes = np.nonzero(change)
+        minima = change[cells, extremes] > 0
+
+        # Segments between consecutive extremes of the same cell, rising
+        # segments (from a minimum) get phases 1-6, falling segments 7-12
+        same_cell = cells[:-1] == cells[1:]
+        starts = extremes[:-1][same_cell]
+        lengths = extremes[1:][same_cell] - starts
+        offsets = cells[:-1][same_cell]*signal.shape[1] + starts
+        first = np.where(minima[:-1][same_cell], 1, 7)
+
+        # Same arithmetic as np.floor(np.linspace(first, first+6, length,
+        # endpoint=False)) for every segment
+        position = np.arange(np.sum(lengths)) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths
+            )
+        phases = np.floor(
+            position*np.repeat(6/lengths, lengths) + np.repeat(first, lengths)
+            )
 
-        # Create a 2D array of sliding indices across the entire length of
-        # input array. Match up with the input sequence & get the matching
-        # starting indices.
-        M = (arr[np.arange(Na-Nseq+1)[:, None] + r_seq] == seq).all(1)
+        binarized = np.zeros(signal.shape, np.uint8)
+        binarized.ravel()[np.repeat(offsets, lengths) + position] = phases
+        return binarized
 
-        # Get the range of those indices as final output
-        if M.any() > 0:
-            return np.where(M)[0]
-        else:
-            return np.array([], dtype="int")  # No match found
-
-    def binarize_fast(self):
-        if self.__distributions is False or self.__filtered_fast is False:
-            raise ValueError("No distribution or filtered data.")
-
-        spikes_th = self.__settings["Exclude"]["Spikes threshold"]
-        self.__binarized_fast = np.zeros((self.__cells, self.__points), int)
-        for cell in range(self.__cells):
-            threshold = 3*self.__distributions[cell]["noise_params"][2]
-            self.__binarized_fast[cell] = np.where(
-                self.__filtered_fast[cell] > threshold, 1, 0
-                )
-            if np.sum(self.__binarized_fast[cell]) < spikes_th*self.__points:
-                self.__good_cells[cell] = False
-
-    def binarize_slow(self):
-        if self.__filtered_slow is False:
-            raise ValueError("No filtered data.")
-        self.__binarized_slow = np.zeros((self.__cells, self.__points), int)
-        for cell in range(self.__cells):
-            signal = self.__filtered_slow[cell]
-            heavisided_gradient = np.heaviside(np.gradient(signal), 0)
-            minima = self.__search_sequence(heavisided_gradient, [0, 1])
-            maxima = self.__search_sequence(heavisided_gradient, [1, 0])
-            extremes = np.sort(np.concatenate((minima, maxima)))
-
-            reverse_mode = False if minima[0] < maxima[0] else True
-
-            self.__binarized_slow[cell, 0:extremes[0]] = 0
-            for i in range(len(extremes)-1):
-                e1, e2 = extremes[i], extremes[i+1]
-                if i % 2 == int(reverse_mode):
-                    self.__binarized_slow[cell, e1:e2] = np.floor(
-                        np.linspace(1, 7, e2-e1, endpoint=False)
-                        )
-                else:
-                    self.__binarized_slow[cell, e1:e2] = np.floor(
-                        np.linspace(7, 13, e2-e1, endpoint=False)
-                        )
-            self.__binarized_slow[cell, extremes[-1]:] = 0
-        self.__binarized_slow = self.__binarized_slow.astype(int)
-
-    def autolimit(self):
-        if self.__binarized_fast is False:
-            raise ValueError("No binarized data.")
+    @instrumented("Data.autolimit", __counts)
+    def autolimit(self, mode="evolution", chunk=None):
+        self.__require("binarized_fast")
         print("Computing activity...")
-        self.__activity = []
-        for cell in range(self.__cells):
-            data = self.__binarized_fast[cell]
-            cumsum = np.cumsum(data)
-
-            sampling = self.__settings["Sampling [Hz]"]
-            stimulation = self.__settings["Stimulation [frame]"][0]
-            lower_limit = cumsum[cumsum < 0.1*cumsum[-1]].size
-            lower_limit /= sampling  # lower limit in seconds
-            upper_limit = (cumsum.size - cumsum[cumsum > 0.9*cumsum[-1]].size)
-            upper_limit /= sampling  # upper limit in seconds
-
-            def box(t, a, t_start, t_end):
-                return a*(np.heaviside(t-t_start, 0)-np.heaviside(t-t_end, 0))
-            res = differential_evolution(
-                lambda p: np.sum((box(self.__time, *p) - data)**2),
-                [[0, 100],
-                 [0, lower_limit+1],
-                 [upper_limit-1, self.__time[-1]]]
+        if mode == "evolution":
+            fit = lambda: np.array(
+                [self.__fit_evolution(cell) for cell in range(self.__cells)]
                 )
-            self.__activity.append(res.x[1:])
+        elif mode == "exact":
+            fit = lambda: self.__fit_exact(chunk)
+        else:
+            raise ValueError("Unknown autolimit mode.")
+        self.__autolimit_mode = mode
+        self.__activity = self.__cached(
+            "activity", lambda: {"activity": fit()}, mode
+            )["activity"]
+        self.__requested.add("activity")
+
+    @instrumented("Data.compare_autolimit", __counts)
+    def compare_autolimit(self, cells=None):
+        self.__require("binarized_fast")
+        cells = np.arange(self.__cells)[slice(None) if cells is None else cells]
+        exact = self.__fit_exact()[cells]
+        evolution = np.array([self.__fit_evolution(cell) for cell in cells])
+        return {
+            "cells": cells,
+            "exact": exact,
+            "evolution": evolution,
+            "difference": np.abs(exact - evolution),
+            "loss_exact": np.array(
+                [self.__box_loss(c, *a) for c, a in zip(cells, exact)]
+                ),
+            "loss_evolution": np.array(
+                [self.__box_loss(c, *a) for c, a in zip(cells, evolution)]
+                )
+            }
 
-            if self.__activity[cell][0] < stimulation/sampling:
-                self.__good_cells[cell] = False
-        self.__activity = np.array(self.__activity)
+    def __activity_limits(self, cumsum):
+        # Times [s] of 10% and 90% of all spikes, works along the last axis
+        sampling = self.__settings["Sampling [Hz]"]
+        total = cumsum[..., -1:]
+        lower_limit = np.sum(cumsum < 0.1*total, axis=-1)/sampling
+        upper_limit = cumsum.shape[-1] - np.sum(cumsum > 0.9*total, axis=-1)
+        return (lower_limit, upper_limit/sampling)
+
+    def __box(self, t, a, t_start, t_end):
+        return a*(np.heaviside(t-t_start, 0)-np.heaviside(t-t_end, 0))
+
+    def __box_loss(self, cell, t_start, t_end):
+        # Squared error of the box with the optimal amplitude
+        data = self.get_binarized_fast(cell)
+        inside = self.__box(self.__time, 1, t_start, t_end) > 0
+        a = np.mean(data[inside]) if np.any(inside) else 0
+        return np.sum((self.__box(self.__time, a, t_start, t_end) - data)**2)
+
+    def __fit_evolution(self, cell):
+        data = self.get_binarized_fast(cell)
+        lower_limit, upper_limit = self.__activity_limits(np.cumsum(data))
+
+        res = differential_evolution(
+            lambda p: np.sum((self.__box(self.__time, *p) - data)**2),
+            [[0, 100],
+             [0, lower_limit+1],
+             [upper_limit-1, self.__time[-1]]]
+            )
+        return res.x[1:]
+
+    def __fit_exact(self, chunk=None):
+        # The box covers samples t_start < t <= t_end, i.e. indices [i, j).
+        # With the optimal amplitude (the mean of the covered samples) the
+        # squared error is sum(x) - S**2/L, so S**2/L is maximized, where S
+        # and L are the number of spikes and samples in [i, j). Optimal
+        # borders lie at the edges of spike runs or at the bounds.
+        time = self.__time
+        activity = np.empty((self.__cells, 2))
+        for start, stop in self.__blocks(chunk):
+            data = self.get_binarized_fast(np.arange(start, stop)).astype(int)
+            cumsum = np.cumsum(data, axis=1)
+            lower_limit, upper_limit = self.__activity_limits(cumsum)
+            prefix = np.zeros((stop-start, self.__points+1), int)
+            prefix[:, 1:] = cumsum
+            # Spike runs start at i and end before j
+            edges = np.diff(data, axis=1, prepend=0, append=0)
+
+            for k in range(stop-start):
+                t_max, t_min = lower_limit[k]+1, upper_limit[k]-1
+                i_lo = 1
+                i_hi = max(np.searchsorted(time, t_max, side="right"), i_lo)
+                j_lo = np.searchsorted(time, t_min, side="right")
+                j_hi = self.__points
+
+                i = np.flatnonzero(edges[k] == 1)
+                i = np.unique(np.concatenate((
+                    [i_lo, i_hi], i[(i >= i_lo) & (i <= i_hi)]
+                    )))
+                j = np.flatnonzero(edges[k] == -1)
+                j = np.unique(np.concatenate((
+                    [j_lo, j_hi], j[(j >= j_lo) & (j <= j_hi)]
+                    )))
+
+                S = prefix[k, j][np.newaxis, :] - prefix[k, i][:, np.newaxis]
+                L = j[np.newaxis, :] - i[:, np.newaxis]
+                score = np.where(L > 0, S**2/np.maximum(L, 1), 0)
+                best_i, best_j = np.unravel_index(np.argmax(score),
+                                                  score.shape
+                                                  )
+                best_i, best_j = i[best_i], j[best_j]
+
+                # Report the middle of the interval of equivalent borders
+                t_start = (time[best_i-1] + time[min(best_i, j_hi-1)])/2
+                if best_j < j_hi:
+                    t_end = (time[max(best_j-1, 0)] + time[best_j])/2
+                else:
+                    t_end = time[-1]
+                activity[start+k] = (np.clip(t_start, 0, t_max),
+                                     np.clip(t_end, t_min, time[-1])
+                                     )
+        return activity
 
     def plot_binarized(self, i):
-        if self.__binarized_slow is False or self.__binarized_fast is False:
-            raise ValueError("No binarized data!")
+        self.__require("binarized_slow")
+        self.__require("binarized_fast")
 
         fig, (ax1, ax2) = plt.subplots(2, 1, sharex=True)
         fig.suptitle("Binarized data")
@@ -473,32 +1046,30 @@ class Data(object):
         return fig
 
     def plot_events(self):
-        if self.__binarized_slow is False or self.__binarized_fast is False:
-            raise ValueError("No binarized data!")
+        self.__require("binarized_fast")
         fig, ax = plt.subplots()
 
-        bin_fast = self.__binarized_fast[self.__good_cells]
-        raster = [[] for i in range(len(bin_fast))]
-        sampling = self.__settings["Sampling [Hz]"]
+        ax.eventplot(self.get_raster(self.get_good_cells()), linewidths=0.1)
+        return fig
 
-        for i in range(len(bin_fast)):
-            for j in range(len(bin_fast[0])):
-                if bin_fast[i, j] == 1:
-                    raster[i].append(j/sampling)
+    def get_raster(self, cells=None):
+        bin_fast = self.get_binarized_fast(
+            slice(None) if cells is None else cells
+            )
+        sampling = self.__settings["Sampling [Hz]"]
+        # Spike times of each cell, nonzero returns them ordered by cell
+        rows, frames = np.nonzero(bin_fast)
+        splits = np.searchsorted(rows, np.arange(1, len(bin_fast)))
+        return np.split(frames/sampling, splits)
 
-        ax.eventplot(raster, linewidths=0.1)
-        return fig
+    def analyze(self):
+        # Computes the missing stages, only data and settings are needed
+        if self.__settings is False:
+            raise ValueError("No imported settings!")
+        for stage in STAGES:
+            self.__require(stage)
 
     def is_analyzed(self):
-        if self.__filtered_slow is False or self.__filtered_fast is False:
+        if self.__signal is False or self.__good_cells is False:
             return False
-        elif self.__distributions is False:
-            return False
-        elif self.__binarized_slow is False or self.__binarized_fast is False:
-            return False
-        elif self.__good_cells is False:
-            return False
-        elif self.__activity is False:
-            return False
-        else:
-            return True
+        return all(self.__stage(stage) is not False for stage in STAGES)
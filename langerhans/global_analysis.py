@@ -11,6 +11,7 @@ from pathlib import Path
 import colorsys
 
 from langerhans.analysis import Analysis
+from langerhans.instrumentation import instrumented
 
 
 def lighten_color(color, amount=0.5):
@@ -42,7 +43,10 @@ LIGHT_RED = lighten_color("C3", 0.8)
 class GlobalAnalysis(object):
     """docstring for GlobalAnalysis."""
 
-    def __init__(self, path):
+    @instrumented("GlobalAnalysis",
+                  lambda self, result: {"series": len(self.__data_dict)}
+                  )
+    def __init__(self, path, restarts=1, seed=None):
         data_path = Path(path)
         if not data_path.exists() or not data_path.is_dir():
             raise ValueError("Directory does not exist.")
@@ -89,7 +93,9 @@ class GlobalAnalysis(object):
             analysis.build_networks()
             network = analysis.get_networks()
 
-            self.__pars_cell[s], self.__pars_network[s] = analysis.compute_parameters()
+            self.__pars_cell[s], self.__pars_network[s] = analysis.get_parameters(
+                restarts, seed
+                )
             self.__spikes_v_phases[s] = analysis.spikes_vs_phase()
             self.__spikes_v_phases_sep[s] = analysis.spikes_vs_phase(mode="separate")
             self.__corr_v_dist[s] = analysis.correlation_vs_distance()
@@ -0,0 +1,137 @@
+import json
+import time
+import functools
+import tracemalloc
+
+# Active profilers and hooks, stages are only measured when there are any
+PROFILERS = []
+HOOKS = []
+# Peak memory of the stages currently running, innermost last
+_STACK = []
+
+
+def add_hook(hook):
+    HOOKS.append(hook)
+
+
+def remove_hook(hook):
+    HOOKS.remove(hook)
+
+
+def instrumented(stage, counts=None):
+    """
+    Decorates a method as an instrumented stage. counts(self, result)
+    returns a dict of item counts (cells, points, edges, events, ...) that
+    is recorded together with wall time, CPU time and peak memory.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not PROFILERS and not HOOKS:
+                return method(self, *args, **kwargs)
+
+            memory = tracemalloc.is_tracing()
+            if memory:
+                current, peak = tracemalloc.get_traced_memory()
+                start_memory = current
+                # The enclosing stage keeps its peak so far before the reset
+                if _STACK:
+                    _STACK[-1] = max(_STACK[-1], peak)
+                tracemalloc.reset_peak()
+            _STACK.append(0)
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                result = method(self, *args, **kwargs)
+            finally:
+                wall = time.perf_counter() - wall
+                cpu = time.process_time() - cpu
+                # Nested stages reset the peak, their peaks are kept on stack
+                peak = max(_STACK.pop(),
+                           tracemalloc.get_traced_memory()[1] if memory else 0
+                           )
+                if _STACK:
+                    _STACK[-1] = max(_STACK[-1], peak)
+
+            record = {
+                "stage": stage,
+                "wall [s]": wall,
+                "cpu [s]": cpu,
+                "peak [MB]": (peak - start_memory)/2**20 if memory else None,
+                "items": counts(self, result) if counts is not None else {}
+                }
+            for profiler in list(PROFILERS):
+                profiler.add(record)
+            for hook in list(HOOKS):
+                hook(record)
+            return result
+        return wrapper
+    return decorator
+
+
+class Profiler(object):
+    """
+    Collects records of instrumented stages while active, e.g.
+
+    >> with Profiler() as profiler:
+    >>     data.filter()
+    >> profiler.to_json("profile.json")
+    """
+
+    def __init__(self, memory=True, callback=None):
+        self.__memory = memory
+        self.__callback = callback
+        self.__records = []
+        self.__started_tracing = False
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exception):
+        self.stop()
+
+    def start(self):
+        if self.__memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.__started_tracing = True
+        PROFILERS.append(self)
+        return self
+
+    def stop(self):
+        if self in PROFILERS:
+            PROFILERS.remove(self)
+        if self.__started_tracing:
+            tracemalloc.stop()
+            self.__started_tracing = False
+
+    def add(self, record):
+        self.__records.append(record)
+        if self.__callback is not None:
+            self.__callback(record)
+
+    def get_records(self): return self.__records
+
+    def summary(self):
+        # Totals of all calls of each stage
+        summary = {}
+        for record in self.__records:
+            stage = summary.setdefault(record["stage"], {
+                "calls": 0, "wall [s]": 0, "cpu [s]": 0, "peak [MB]": None
+                })
+            stage["calls"] += 1
+            stage["wall [s]"] += record["wall [s]"]
+            stage["cpu [s]"] += record["cpu [s]"]
+            if record["peak [MB]"] is not None:
+                stage["peak [MB]"] = max(stage["peak [MB]"] or 0,
+                                         record["peak [MB]"]
+                                         )
+        return summary
+
+    def to_json(self, path=None):
+        text = json.dumps(
+            {"records": self.__records, "summary": self.summary()},
+            indent=2, default=float
+            )
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(text)
+        return text
@@ -3,19 +3,435 @@ import networkx as nx
 from community import community_louvain
 import matplotlib.pyplot as plt
 from scipy.optimize import bisect
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.stats import norm
+from scipy.fft import rfft, irfft
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import tempfile
+
+from .instrumentation import instrumented
+
+
+def _row_statistics(X, block):
+    # Row means and norms of centered rows, read in blocks of rows
+    mean = np.empty(len(X))
+    norm = np.empty(len(X))
+    for start in range(0, len(X), block):
+        rows = np.asarray(X[start:start+block], dtype=float)
+        mean[start:start+block] = np.mean(rows, axis=1)
+        centered = rows - mean[start:start+block, np.newaxis]
+        norm[start:start+block] = np.sqrt(np.sum(centered**2, axis=1))
+    return (mean, norm)
+
+
+def correlation_matrix(X, dtype="float64", block=None):
+    """
+    Pearson correlation matrix of the rows of X from standardized rows,
+    R = Z Z^T. With block, rows are standardized and multiplied in blocks of
+    that many rows, so only the output and two blocks are held in memory.
+    """
+    cells = len(X)
+    block = cells if block is None else max(int(block), 1)
+    R = np.empty((cells, cells), dtype=dtype)
+
+    # Row means and norms are computed first so blocks are standardized alone
+    mean, norm = _row_statistics(X, block)
+
+    def standardized(start):
+        rows = np.asarray(X[start:start+block], dtype=dtype)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return ((rows - mean[start:start+block, np.newaxis].astype(dtype))
+                    / norm[start:start+block, np.newaxis].astype(dtype))
+
+    for i in range(0, cells, block):
+        Z_i = standardized(i)
+        for j in range(0, i + block, block):
+            Z_j = Z_i if j == i else standardized(j)
+            R[i:i+block, j:j+block] = Z_i @ Z_j.T
+            R[j:j+block, i:i+block] = R[i:i+block, j:j+block].T
+    np.clip(R, -1, 1, out=R)
+    np.fill_diagonal(R, 1)
+    return R
+
+
+def standardize(X, dtype="float32", block=1024, file=None):
+    """
+    Writes the standardized rows of X (zero mean, unit norm) block by block
+    to a memory map on file, a temporary file by default.
+    """
+    mean, norm = _row_statistics(X, block)
+    file = tempfile.TemporaryFile() if file is None else file
+    Z = np.memmap(file, dtype=dtype, mode="w+", shape=np.shape(X))
+    for start in range(0, len(X), block):
+        rows = np.asarray(X[start:start+block], dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            Z[start:start+block] = ((rows - mean[start:start+block, np.newaxis])
+                                    / norm[start:start+block, np.newaxis])
+    Z.flush()
+    return Z
+
+
+def correlation_graph(Z, ND_avg=8, mode="edges", block=1024):
+    """
+    Streams correlation blocks of the standardized rows Z and keeps either
+    the ND_avg*n/2 most correlated pairs ("edges", ties at the threshold are
+    broken arbitrarily) or the ceil(ND_avg/2) most correlated partners of
+    each cell ("rows", their union has mean degree between ND_avg/2 and
+    ND_avg). Returns the edge rows, columns and correlations and the mean of
+    the upper triangle of R with the diagonal.
+    """
+    if mode not in ("edges", "rows"):
+        raise ValueError("Unknown streaming mode.")
+    cells = len(Z)
+    edges = int(np.ceil(ND_avg*cells/2))
+    k = min(int(np.ceil(ND_avg/2)), cells-1)
+    total = 0.0
+
+    rows, columns, values = np.empty(0, int), np.empty(0, int), np.empty(0)
+    top_values = np.full((cells, k), -np.inf)
+    top_columns = np.zeros((cells, k), int)
+
+    def merge_rows(start, R, offset):
+        # Top k partners of rows from their kept and new candidates
+        stop = start + len(R)
+        candidates = np.hstack((top_values[start:stop], R))
+        indices = np.hstack((
+            top_columns[start:stop],
+            np.broadcast_to(np.arange(offset, offset+R.shape[1]), R.shape)
+            ))
+        best = np.argpartition(-candidates, k-1, axis=1)[:, :k]
+        top_values[start:stop] = np.take_along_axis(candidates, best, 1)
+        top_columns[start:stop] = np.take_along_axis(indices, best, 1)
+
+    for i in range(0, cells, block):
+        Z_i = np.asarray(Z[i:i+block], dtype=float)
+        for j in range(0, i + block, block):
+            Z_j = Z_i if j == i else np.asarray(Z[j:j+block], dtype=float)
+            R = np.clip(Z_i @ Z_j.T, -1, 1)
+            if j == i:
+                # Each pair once, the diagonal counts in the average only
+                total += np.sum(np.triu(R, 1)) + len(R)
+                R[np.triu_indices(len(R))] = np.nan
+            else:
+                total += np.sum(R)
+            R[np.isnan(R)] = -np.inf
+
+            if mode == "rows":
+                if k > 0 and j == i:
+                    merge_rows(i, np.maximum(R, R.T), j)
+                elif k > 0:
+                    merge_rows(i, R, j)
+                    merge_rows(j, R.T, i)
+                continue
+            # Candidates over the smallest kept correlation once full
+            floor = np.min(values) if values.size >= edges else -np.inf
+            r, c = np.nonzero(R > floor)
+            rows = np.r_[rows, r + i]
+            columns = np.r_[columns, c + j]
+            values = np.r_[values, R[r, c]]
+            if values.size > edges:
+                keep = np.argpartition(-values, edges-1)[:edges] if edges > 0 else []
+                rows, columns, values = rows[keep], columns[keep], values[keep]
+
+    if mode == "rows":
+        valid = np.isfinite(top_values)
+        rows = np.repeat(np.arange(cells), k)[valid.ravel()]
+        columns = top_columns[valid]
+        values = top_values[valid]
+    mean = total/(cells*(cells+1)/2) if cells > 0 else np.nan
+    return (rows, columns, values, mean)
+
+
+def sliding_correlations(X, window, step=1, refresh=1000):
+    """
+    Yields the first frame and correlation matrix of the rows of X for each
+    window of frames. Sums of x, x^2 and xy are updated with the frames
+    leaving and entering the window, they are recomputed from scratch every
+    refresh windows to bound rounding errors.
+    """
+    X = np.asarray(X, dtype=float)
+    # Rows are centered first so running sums do not cancel catastrophically
+    X = X - np.mean(X, axis=1)[:, np.newaxis]
+    points = X.shape[1]
+    for n, start in enumerate(range(0, points-window+1, step)):
+        stop = start + window
+        if n % refresh == 0 or step >= window:
+            W = X[:, start:stop]
+            S_x, S_xx, S_xy = np.sum(W, axis=1), np.sum(W**2, axis=1), W @ W.T
+        else:
+            leaving = X[:, start-step:start]
+            entering = X[:, stop-step:stop]
+            S_x += np.sum(entering, axis=1) - np.sum(leaving, axis=1)
+            S_xx += np.sum(entering**2, axis=1) - np.sum(leaving**2, axis=1)
+            S_xy += entering @ entering.T - leaving @ leaving.T
+        mean = S_x/window
+        covariance = S_xy/window - np.outer(mean, mean)
+        deviation = np.sqrt(np.maximum(S_xx/window - mean**2, 0))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            R = covariance/np.outer(deviation, deviation)
+        np.clip(R, -1, 1, out=R)
+        np.fill_diagonal(R, 1)
+        yield (start, R)
+
+
+def _exceedances(X_f, R, points, generators, method):
+    # Number of surrogates whose correlation reaches R for every pair, each
+    # surrogate has its own generator so batching does not change results
+    cells, frequencies = X_f.shape
+    phases = np.empty((len(generators), cells, frequencies))
+    for i, rng in enumerate(generators):
+        if method == "phase":
+            phases[i] = rng.uniform(0, 2*np.pi, (cells, frequencies))
+        else:
+            # A circular shift by s frames is a linear phase in frequency
+            shifts = rng.integers(0, points, (cells, 1))
+            phases[i] = shifts*(-2*np.pi*np.arange(frequencies)/points)
+    if method == "phase":
+        # Random phases per cell keep each spectrum, zero and Nyquist
+        # frequencies stay real
+        phases[..., 0] = 0
+        if points % 2 == 0:
+            phases[..., -1] = 0
+    # Spectra of the surrogates are built in place from the phases
+    S_f = np.empty(phases.shape, complex)
+    np.cos(phases, out=S_f.real)
+    np.sin(phases, out=S_f.imag)
+    del phases
+    S_f *= X_f
+    S = irfft(S_f, n=points, axis=-1)
+    del S_f
+    S -= np.mean(S, axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        S /= np.sqrt(np.sum(S**2, axis=-1, keepdims=True))
+    exceedances = np.zeros((cells, cells), int)
+    for s in S:
+        exceedances += s @ s.T >= R - 1e-12
+    return exceedances
+
+
+def surrogate_batch(cells, points, memory=2**28, workers=1):
+    """
+    Number of surrogates per batch so that the batches of all workers fit in
+    memory bytes. A surrogate needs its phases, spectrum and signal, about
+    three float arrays of the size of X.
+    """
+    per_surrogate = 8*cells*(3*points + cells)
+    return max(int(memory//(workers*per_surrogate)), 1)
+
+
+def surrogate_pvalues(X, surrogates=1000, method="phase", memory=2**28, workers=1, seed=None):
+    """
+    One-sided p-values of the correlations of the rows of X against phase
+    randomized ("phase") or circularly shifted ("shift") surrogates of all
+    rows at once. Surrogates are made in batches with FFTs, sized so that the
+    batches of all workers take about memory bytes, and batches run in
+    threads. Every surrogate has an independent seed, so the p-values do not
+    depend on memory or workers.
+    """
+    if method not in ("phase", "shift"):
+        raise ValueError("Unknown surrogate method.")
+    X = np.asarray(X, dtype=float)
+    cells, points = X.shape
+    R = correlation_matrix(X)
+    X_f = rfft(X, axis=-1)
+    batch = surrogate_batch(cells, points, memory, workers)
+    generators = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(surrogates)]
+    arguments = [(X_f, R, points, generators[i:i+batch], method) for i in range(0, surrogates, batch)]
+    if workers == 1:
+        exceedances = [_exceedances(*a) for a in arguments]
+    else:
+        with ThreadPoolExecutor(workers) as executor:
+            exceedances = list(executor.map(lambda a: _exceedances(*a), arguments))
+    P = (1 + np.sum(exceedances, axis=0))/(1 + surrogates)
+    P[np.isnan(R)] = 1
+    np.fill_diagonal(P, 0)
+    return P
+
+
+def significant_pairs(P, alpha=0.05, fdr=False):
+    """
+    Pairs (i > j) with p-values at most alpha, or with the Benjamini-Hochberg
+    false discovery rate alpha when fdr is set.
+    """
+    rows, columns = np.tril_indices(len(P), -1)
+    p = P[rows, columns]
+    if fdr and p.size > 0:
+        order = np.argsort(p)
+        passed = p[order] <= alpha*np.arange(1, p.size+1)/p.size
+        largest = np.nonzero(passed)[0]
+        keep = np.zeros(p.size, bool)
+        if largest.size > 0:
+            keep[order[:largest[-1]+1]] = True
+    else:
+        keep = p <= alpha
+    return (rows[keep], columns[keep])
+
+
+def network_family(R, ND_values):
+    """
+    Networks of R for every target mean degree in ND_values from one sweep
+    over pairs sorted from the strongest to the weakest correlation. The
+    components are kept with union-find and the degrees incrementally. As in
+    exact mode, each target keeps all pairs at or above the threshold of the
+    ceil(ND*n/2)-th strongest pair, or above it if that is closer to ND.
+    """
+    cells = len(R)
+    rows, columns = np.tril_indices(cells, -1)
+    values = R[rows, columns]
+    valid = ~np.isnan(values)
+    rows, columns, values = rows[valid], columns[valid], values[valid]
+    order = np.argsort(-values, kind="stable")
+    negated = -values[order]
+
+    # Edge counts of the thresholds chosen as in exact mode, pairs above the
+    # k-th strongest correlation or with all its ties, whichever is closer
+    ND_values = np.asarray(ND_values, dtype=float)
+    edges = ND_values*cells/2
+    k = np.clip(np.ceil(edges).astype(int), 0, values.size)
+    lower = negated[np.maximum(k-1, 0)] if values.size else np.zeros(k.size)
+    upper = np.searchsorted(negated, lower, side="left")
+    ties = np.searchsorted(negated, lower, side="right")
+    closer = (upper > 0) & (k < values.size) & (
+        np.abs(upper-edges) < np.abs(ties-edges)
+        )
+    targets = np.where(k == 0, 0, np.where(closer, upper, ties))
+    results = {key: np.empty(ND_values.size) for key in (
+        "threshold", "ND", "MCC", "isolated"
+        )}
+    results["components"] = np.empty(ND_values.size, int)
+    results["max_degree"] = np.empty(ND_values.size, int)
+
+    parent = list(range(cells))
+    size = [1]*cells
+    degree = np.zeros(cells, int)
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    largest, components, isolated, max_degree = min(cells, 1), cells, cells, 0
+    added = 0
+    for t in np.argsort(targets, kind="stable"):
+        while added < targets[t]:
+            e = order[added]
+            i, j = int(rows[e]), int(columns[e])
+            for node in (i, j):
+                isolated -= degree[node] == 0
+                degree[node] += 1
+                max_degree = max(max_degree, degree[node])
+            a, b = find(i), find(j)
+            if a != b:
+                if size[a] < size[b]:
+                    a, b = b, a
+                parent[b] = a
+                size[a] += size[b]
+                largest = max(largest, size[a])
+                components -= 1
+            added += 1
+        results["threshold"][t] = values[order[added-1]] if added > 0 else np.inf
+        results["ND"][t] = 2*added/cells
+        results["MCC"][t] = largest/cells
+        results["components"][t] = components
+        results["isolated"][t] = isolated/cells
+        results["max_degree"][t] = max_degree
+    results["ND_avg"] = ND_values
+    return results
+
+
+def _efficiencies(A, sources):
+    # Sums of inverse BFS distances from each source, unreachable pairs add 0
+    D = csgraph.shortest_path(A, unweighted=True, indices=sources)
+    D[np.arange(len(sources)), sources] = np.inf
+    return np.sum(1/D, axis=1)
+
+
+def efficiencies(A, sources=None, workers=1, block=256):
+    """
+    Nodal efficiencies of the sources (all nodes by default) from csgraph
+    shortest paths, computed in blocks of sources, in parallel with workers.
+    """
+    cells = A.shape[0]
+    sources = np.arange(cells) if sources is None else np.asarray(sources)
+    if cells < 2:
+        return np.zeros(sources.size)
+    blocks = [sources[i:i+block] for i in range(0, sources.size, block)]
+    if workers == 1 or len(blocks) == 1:
+        sums = [_efficiencies(A, b) for b in blocks]
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            sums = list(executor.map(_efficiencies, [A]*len(blocks), blocks))
+    return np.concatenate(sums)/(cells-1)
+
+
+def _louvain(A, seed):
+    # One Louvain run, the partition is returned as community labels
+    G = nx.from_scipy_sparse_array(A)
+    partition = community_louvain.best_partition(G, random_state=seed)
+    labels = np.array([partition[node] for node in range(A.shape[0])])
+    return (labels, community_louvain.modularity(partition, G))
+
+
+def communities(A, restarts=1, seed=None, workers=1, mode="best"):
+    """
+    Louvain partition of the graph with adjacency A from restarts seeded by
+    seed, in parallel with workers. Mode "best" keeps the partition with the
+    highest modularity, "consensus" connects pairs of adjacent nodes that
+    share a community in at least half of the restarts and takes the
+    connected components. Returns the labels, their modularity and the
+    modularities of all restarts.
+    """
+    if mode not in ("best", "consensus"):
+        raise ValueError("Unknown partition mode.")
+    seeds = np.random.SeedSequence(seed).generate_state(restarts)
+    if workers == 1 or restarts == 1:
+        runs = [_louvain(A, int(s)) for s in seeds]
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            runs = list(executor.map(_louvain, [A]*restarts, seeds.tolist()))
+    labels = np.array([r[0] for r in runs])
+    Q = np.array([r[1] for r in runs])
+
+    if mode == "best":
+        return {"labels": labels[np.argmax(Q)], "Q": np.max(Q), "Q_all": Q}
+    # Fraction of restarts in which the ends of each edge share a community
+    rows, columns = sparse.triu(A, 1).nonzero()
+    together = np.mean(labels[:, rows] == labels[:, columns], axis=0)
+    keep = together >= 0.5
+    C = sparse.coo_matrix(
+        (np.ones(np.count_nonzero(keep)), (rows[keep], columns[keep])),
+        shape=A.shape
+        )
+    consensus = csgraph.connected_components(C, directed=False)[1]
+    G = nx.from_scipy_sparse_array(A)
+    Q_consensus = community_louvain.modularity(dict(enumerate(consensus.tolist())), G)
+    return {"labels": consensus, "Q": Q_consensus, "Q_all": Q}
+
 
 class Networks(object):
     """docstring for Networks."""
 
 # ------------------------------- INITIALIZER -------------------------------- #
-    def __init__(self, cells, filtered_slow, filtered_fast, ND_avg=8):
+    def __init__(self, cells, filtered_slow, filtered_fast, ND_avg=8,
+                 dtype="float64", block=None):
         self.__ND_avg = ND_avg
+        self.__dtype = dtype
+        self.__block = block
         self.__cells = cells
         self.__filtered_slow = filtered_slow
         self.__filtered_fast = filtered_fast
 
         self.__R_slow = False
         self.__R_fast = False
+        self.__R_mean = False
+
+        self.__P = {}
+
+        # Standardized signals on disk for streaming modes
+        self.__Z_slow = False
+        self.__Z_fast = False
 
         self.__A_slow = False
         self.__A_fast = False
@@ -23,87 +439,278 @@ class Networks(object):
         self.__G_slow = False
         self.__G_fast = False
 
+        self.__threshold_slow = False
+        self.__threshold_fast = False
+
+        self.__metrics = False
+        self.__components = False
+        self.__communities = {}
+
+    def __counts(self, result=None):
+        edges = [0 if A is False else A.nnz//2
+                 for A in (self.__A_slow, self.__A_fast)
+                 ]
+        return {"cells": self.__cells, "edges slow": edges[0], "edges fast": edges[1]}
+
 # --------------------------------- GETTERS ---------------------------------- #
 
-    def get_G_slow(self): return self.__G_slow
-    def get_G_fast(self): return self.__G_fast
+    def get_G_slow(self):
+        # Graphs are only built from the sparse adjacency when asked for
+        if self.__G_slow is False and self.__A_slow is not False:
+            self.__G_slow = nx.from_scipy_sparse_array(self.__A_slow)
+        return self.__G_slow
+
+    def get_G_fast(self):
+        if self.__G_fast is False and self.__A_fast is not False:
+            self.__G_fast = nx.from_scipy_sparse_array(self.__A_fast)
+        return self.__G_fast
+
     def get_R_slow(self): return self.__R_slow
     def get_R_fast(self): return self.__R_fast
     def get_A_slow(self): return self.__A_slow
     def get_A_fast(self): return self.__A_fast
+    def get_threshold_slow(self): return self.__threshold_slow
+    def get_threshold_fast(self): return self.__threshold_fast
 
 # ----------------------------- NETWORK METHODS ------------------------------ #
-    def build_networks(self):
-        # Compute correlation matrices
-        self.__construct_correlation_matrix()
-        # Calculate threshold and construct network
-        slow_threshold, r = bisect(lambda x: self.__graph_from_threshold(self.__R_slow, x)["ND"]-self.__ND_avg, 0, 1, full_output=True)
-        # Calculate threshold and construct network
-        fast_threshold, r = bisect(lambda x: self.__graph_from_threshold(self.__R_fast, x)["ND"]-self.__ND_avg, 0, 1, full_output=True)
+    @instrumented("Networks.build_networks", __counts)
+    def build_networks(self, ND_avg=None, mode="bisect"):
+        if mode not in ("bisect", "exact", "stream", "knn"):
+            raise ValueError("Unknown threshold mode.")
+        if ND_avg is not None:
+            self.__ND_avg = ND_avg
+        if mode in ("stream", "knn"):
+            self.__stream_networks("edges" if mode == "stream" else "rows")
+            return
+        # Compute correlation matrices, they are reused on rebuilding
+        if self.__R_slow is False or self.__R_fast is False:
+            self.__construct_correlation_matrix()
+        if mode == "bisect":
+            # Calculate threshold and construct network
+            slow_threshold, r = bisect(lambda x: self.__degree_from_threshold(self.__R_slow, x)-self.__ND_avg, 0, 1, full_output=True)
+            # Calculate threshold and construct network
+            fast_threshold, r = bisect(lambda x: self.__degree_from_threshold(self.__R_fast, x)-self.__ND_avg, 0, 1, full_output=True)
+        else:
+            slow_threshold = self.__exact_threshold(self.__R_slow)
+            fast_threshold = self.__exact_threshold(self.__R_fast)
+        self.__threshold_slow = slow_threshold
+        self.__threshold_fast = fast_threshold
 
-        # self.__G_slow = self.__graph_from_threshold(self.__R_slow, slow_threshold)["G"]
-        self.__G_slow = self.__graph_from_threshold(self.__R_slow, slow_threshold)["G"]
-        self.__G_fast = self.__graph_from_threshold(self.__R_fast, fast_threshold)["G"]
+        self.__A_slow = self.__adjacency_from_threshold(self.__R_slow, slow_threshold)
+        self.__A_fast = self.__adjacency_from_threshold(self.__R_fast, fast_threshold)
+        self.__clear()
 
-        self.__A_slow = nx.to_numpy_matrix(self.__G_slow)
-        self.__A_fast = nx.to_numpy_matrix(self.__G_fast)
+    def __stream_networks(self, mode):
+        # Correlations are streamed from standardized signals on disk, only
+        # the kept edges are held in memory
+        block = 1024 if self.__block is None else self.__block
+        if self.__Z_slow is False:
+            self.__Z_slow = standardize(self.__filtered_slow, self.__dtype, block)
+            self.__Z_fast = standardize(self.__filtered_fast, self.__dtype, block)
+        slow = correlation_graph(self.__Z_slow, self.__ND_avg, mode, block)
+        fast = correlation_graph(self.__Z_fast, self.__ND_avg, mode, block)
+        self.__A_slow = self.__adjacency(slow[0], slow[1])
+        self.__A_fast = self.__adjacency(fast[0], fast[1])
+        self.__threshold_slow = np.min(slow[2]) if slow[2].size else np.inf
+        self.__threshold_fast = np.min(fast[2]) if fast[2].size else np.inf
+        self.__R_mean = (slow[3], fast[3])
+        self.__clear()
+
+    def __clear(self):
+        # Everything derived from the adjacency is recomputed on demand
+        self.__G_slow = False
+        self.__G_fast = False
+        self.__metrics = False
+        self.__components = False
+        self.__communities = {}
 
     def __construct_correlation_matrix(self):
-        self.__R_slow, self.__R_fast = np.eye(self.__cells), np.eye(self.__cells)
-        for i in range(self.__cells):
-            for j in range(i):
-                corr_slow = np.corrcoef(self.__filtered_slow[i], self.__filtered_slow[j])[0,1]
-                self.__R_slow[i,j], self.__R_slow[j,i] = corr_slow, corr_slow
-                corr_fast = np.corrcoef(self.__filtered_fast[i], self.__filtered_fast[j])[0,1]
-                self.__R_fast[i,j], self.__R_fast[j,i] = corr_fast, corr_fast
-
-    def __graph_from_threshold(self, R, R_threshold):
-        G = nx.Graph()
-        for i in range(self.__cells):
-            G.add_node(i)
-            for j in range(i):
-                if R[i,j] >= R_threshold:
-                    G.add_edge(i,j)
-        ND = np.mean([G.degree(i) for i in G])
-        return {"G": G, "ND": ND}
+        self.__R_slow = correlation_matrix(self.__filtered_slow, self.__dtype, self.__block)
+        self.__R_fast = correlation_matrix(self.__filtered_fast, self.__dtype, self.__block)
+
+    def __exact_threshold(self, R, ND_avg=None):
+        # Correlations of all pairs, NaN pairs are never connected
+        ND_avg = self.__ND_avg if ND_avg is None else ND_avg
+        values = R[np.triu_indices(self.__cells, 1)]
+        values = values[~np.isnan(values)]
+        edges = ND_avg*self.__cells/2
+        k = int(np.ceil(edges))
+        if k <= 0 or values.size == 0:
+            return np.inf
+        if k >= values.size:
+            return np.min(values)
+        # The k-th largest correlation keeps at least k edges, with ties more
+        lower = np.partition(values, values.size-k)[values.size-k]
+        upper = values[values > lower]
+        # Of the two neighbouring thresholds the one closer to ND_avg is taken
+        if upper.size > 0 and abs(upper.size-edges) < abs(np.count_nonzero(values >= lower)-edges):
+            return np.min(upper)
+        return lower
+
+    def __degree_from_threshold(self, R, R_threshold):
+        return 2*np.count_nonzero(np.tril(R >= R_threshold, -1))/self.__cells
+
+    def __adjacency_from_threshold(self, R, R_threshold):
+        rows, columns = np.nonzero(np.tril(R >= R_threshold, -1))
+        return self.__adjacency(rows, columns)
+
+    def __adjacency(self, rows, columns):
+        # Symmetric CSR adjacency of the pairs, duplicates are merged
+        A = sparse.coo_matrix(
+            (np.ones(2*rows.size), (np.r_[rows, columns], np.r_[columns, rows])),
+            shape=(self.__cells, self.__cells)
+            ).tocsr()
+        A.data[:] = 1
+        A.sort_indices()
+        return A
+
+    def node_metrics(self):
+        # Per-node metric vectors of both bands, kept until rebuilding
+        if self.__metrics is False:
+            self.__metrics = (self.__node_metrics(self.__A_slow),
+                              self.__node_metrics(self.__A_fast))
+        return self.__metrics
+
+    def __node_metrics(self, A):
+        degree = np.diff(A.indptr)
+        # Closed walks of length 3 through each node count its triangles twice
+        triangles = np.asarray((A @ A).multiply(A).sum(axis=1)).ravel()/2
+        pairs = degree*(degree-1)/2
+        neighbours_degree = A @ degree.astype(float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            clustering = np.where(degree > 1, triangles/pairs, 0)
+            nnd = np.where(degree > 0, neighbours_degree/degree, 0)
+        return {"degree": degree, "triangles": triangles,
+                "clustering": clustering, "nearest_neighbour_degree": nnd}
 
     def node_degree(self, cell):
-        return (self.__G_slow.degree(cell),
-                self.__G_fast.degree(cell))
+        slow, fast = self.node_metrics()
+        return (int(slow["degree"][cell]), int(fast["degree"][cell]))
 
     def clustering(self, cell):
-        return (nx.clustering(self.__G_slow)[cell],
-                nx.clustering(self.__G_fast)[cell])
+        slow, fast = self.node_metrics()
+        return (slow["clustering"][cell], fast["clustering"][cell])
 
     def nearest_neighbour_degree(self, cell):
-        return (nx.average_neighbor_degree(self.__G_slow)[cell],
-                nx.average_neighbor_degree(self.__G_fast)[cell])
+        slow, fast = self.node_metrics()
+        return (slow["nearest_neighbour_degree"][cell],
+                fast["nearest_neighbour_degree"][cell])
 
-    def modularity(self):
-        partition_slow = community_louvain.best_partition(self.__G_slow)
-        partition_fast = community_louvain.best_partition(self.__G_fast)
-        Q_slow = community_louvain.modularity(partition_slow, self.__G_slow)
-        Q_fast = community_louvain.modularity(partition_fast, self.__G_fast)
+    def communities(self, restarts=1, seed=None, workers=1, mode="best"):
+        # Partitions of both bands, kept per arguments until rebuilding
+        key = (restarts, seed, mode)
+        if key not in self.__communities:
+            self.__communities[key] = tuple(
+                communities(A, restarts, seed, workers, mode)
+                for A in (self.__A_slow, self.__A_fast)
+                )
+        return self.__communities[key]
 
-        return (Q_slow, Q_fast)
+    @instrumented("Networks.modularity", __counts)
+    def modularity(self, restarts=1, seed=None, workers=1, mode="best"):
+        slow, fast = self.communities(restarts, seed, workers, mode)
+        return (slow["Q"], fast["Q"])
 
-    def global_efficiency(self):
-        GE_slow = nx.global_efficiency(self.__G_slow)
-        GE_fast = nx.global_efficiency(self.__G_fast)
+    @instrumented("Networks.global_efficiency", __counts)
+    def global_efficiency(self, workers=1, block=256):
+        GE_slow = np.mean(efficiencies(self.__A_slow, workers=workers, block=block))
+        GE_fast = np.mean(efficiencies(self.__A_fast, workers=workers, block=block))
         return (GE_slow, GE_fast)
 
+    @instrumented("Networks.sliding_networks", __counts)
+    def sliding_networks(self, window, step=None, band="fast", ND_avg=None):
+        # Networks of windows of frames, each thresholded to ND_avg exactly
+        if band not in ("slow", "fast"):
+            raise ValueError("Unknown band.")
+        filtered = self.__filtered_slow if band == "slow" else self.__filtered_fast
+        step = window if step is None else step
+        if window > filtered.shape[1] or window < 2 or step < 1:
+            raise ValueError("Bad window.")
+
+        results = {"start": [], "threshold": [], "ND": [], "GE": [], "MCC": []}
+        for start, R in sliding_correlations(filtered, window, step):
+            threshold = self.__exact_threshold(R, ND_avg)
+            A = self.__adjacency_from_threshold(R, threshold)
+            results["start"].append(start)
+            results["threshold"].append(threshold)
+            results["ND"].append(A.nnz/self.__cells)
+            results["GE"].append(np.mean(efficiencies(A)))
+            results["MCC"].append(self.__max_component(A)/self.__cells)
+        return {key: np.array(value) for key, value in results.items()}
+
+    @instrumented("Networks.network_family", __counts)
+    def network_family(self, ND_values):
+        # Metrics of both bands for every target degree from one edge sweep.
+        # The sweep needs dense correlation matrices, after streamed builds
+        # they are computed here and kept, which takes O(n^2) memory
+        if self.__R_slow is False or self.__R_fast is False:
+            self.__construct_correlation_matrix()
+        return (network_family(self.__R_slow, ND_values),
+                network_family(self.__R_fast, ND_values))
+
+    @instrumented("Networks.surrogate_pvalues", __counts)
+    def surrogate_pvalues(self, band="fast", surrogates=1000, method="phase", memory=2**28, workers=1, seed=None):
+        # P-values of each band are kept per arguments
+        if band not in ("slow", "fast"):
+            raise ValueError("Unknown band.")
+        key = (band, surrogates, method, seed)
+        if key not in self.__P:
+            filtered = self.__filtered_slow if band == "slow" else self.__filtered_fast
+            self.__P[key] = surrogate_pvalues(filtered, surrogates, method, memory, workers, seed)
+        return self.__P[key]
+
+    def significant_network(self, band="fast", alpha=0.05, fdr=False, **kwargs):
+        # Adjacency of pairs more correlated than in surrogates
+        P = self.surrogate_pvalues(band, **kwargs)
+        return self.__adjacency(*significant_pairs(P, alpha, fdr))
+
+    @instrumented("Networks.global_efficiency_estimate", __counts)
+    def global_efficiency_estimate(self, samples=100, confidence=0.95, seed=None, workers=1):
+        # Mean nodal efficiency of randomly sampled sources, with the half
+        # width of its confidence interval (finite population corrected)
+        rng = np.random.default_rng(seed)
+        samples = min(samples, self.__cells)
+        sources = rng.choice(self.__cells, samples, replace=False)
+        z = norm.ppf(0.5 + confidence/2)
+        estimates = []
+        for A in (self.__A_slow, self.__A_fast):
+            e = efficiencies(A, sources, workers)
+            if samples < 2 or samples == self.__cells:
+                error = 0.0
+            else:
+                correction = (self.__cells-samples)/(self.__cells-1)
+                error = z*np.std(e, ddof=1)/np.sqrt(samples)*np.sqrt(correction)
+            estimates.append((np.mean(e), error))
+        return tuple(estimates)
+
+    def components(self):
+        # Connected component labels of both bands, kept until rebuilding
+        if self.__components is False:
+            self.__components = tuple(
+                csgraph.connected_components(A, directed=False)[1]
+                for A in (self.__A_slow, self.__A_fast)
+                )
+        return self.__components
+
+    def __max_component(self, A):
+        _, labels = csgraph.connected_components(A, directed=False)
+        return np.max(np.bincount(labels))
+
+    @instrumented("Networks.max_connected_component", __counts)
     def max_connected_component(self):
-        MS_slow = len(max(nx.connected_components(self.__G_slow), key=len))/self.__cells
-        MS_fast = len(max(nx.connected_components(self.__G_fast), key=len))/self.__cells
+        labels_slow, labels_fast = self.components()
+        MS_slow = np.max(np.bincount(labels_slow))/self.__cells
+        MS_fast = np.max(np.bincount(labels_fast))/self.__cells
         return (MS_slow, MS_fast)
 
     def average_correlation(self):
-        R_slow = np.matrix(self.__R_slow)
-        R_fast = np.matrix(self.__R_fast)
-        R_slow_upper = R_slow[np.triu_indices(R_slow.shape[0])]
-        R_fast_upper = R_fast[np.triu_indices(R_fast.shape[0])]
+        # Streamed networks keep only the mean of correlations
+        if self.__R_slow is False and self.__R_mean is not False:
+            return self.__R_mean
+        R_slow_upper = self.__R_slow[np.triu_indices(self.__R_slow.shape[0])]
+        R_fast_upper = self.__R_fast[np.triu_indices(self.__R_fast.shape[0])]
         return (R_slow_upper.mean(), R_fast_upper.mean())
 
     def draw_networks(self, positions, ax1, ax2, colors):
-        nx.draw(self.__G_slow, pos=positions, ax=ax1, with_labels=True, node_size=50, width=0.25, font_size=3, node_color=colors[0])
-        nx.draw(self.__G_fast, pos=positions, ax=ax2, with_labels=True, node_size=50, width=0.25, font_size=3, node_color=colors[1])
+        nx.draw(self.get_G_slow(), pos=positions, ax=ax1, with_labels=True, node_size=50, width=0.25, font_size=3, node_color=colors[0])
+        nx.draw(self.get_G_fast(), pos=positions, ax=ax2, with_labels=True, node_size=50, width=0.25, font_size=3, node_color=colors[1])
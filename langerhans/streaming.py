@@ -0,0 +1,145 @@
+import numpy as np
+
+from scipy.signal import butter, sosfilt, sosfilt_zi
+
+from .data import Data, SAMPLE_SETTINGS
+
+
+class StreamingData(object):
+    """
+    A class for online signal analysis during acquisition.
+    """
+# ------------------------------- INITIALIZER ---------------------------------
+    def __init__(self, cells, settings=SAMPLE_SETTINGS, capacity=1024):
+        self.__settings = settings
+        self.__cells = cells
+        self.__points = 0
+
+        self.__sos_slow = self.__sos(*settings["Filter"]["Slow [Hz]"])
+        self.__sos_fast = self.__sos(*settings["Filter"]["Fast [Hz]"])
+        self.__zi_slow = False
+        self.__zi_fast = False
+
+        # Running sums of the fast signal before stimulation
+        self.__noise_n = 0
+        self.__noise_sum = np.zeros(cells)
+        self.__noise_sum2 = np.zeros(cells)
+
+        self.__time = np.empty(capacity)
+        self.__signal = np.empty((cells, capacity))
+        self.__filtered_slow = np.empty((cells, capacity))
+        self.__filtered_fast = np.empty((cells, capacity))
+        self.__binarized_fast = np.empty((cells, capacity), np.uint8)
+
+# --------------------------------- GETTERS -----------------------------------
+
+    def get_settings(self): return self.__settings
+    def get_cells(self): return self.__cells
+    def get_points(self): return self.__points
+    def get_time(self): return self.__time[:self.__points]
+    def get_signal(self): return self.__signal[:, :self.__points]
+
+    def get_filtered_slow(self):
+        return self.__filtered_slow[:, :self.__points]
+
+    def get_filtered_fast(self):
+        return self.__filtered_fast[:, :self.__points]
+
+    def get_binarized_fast(self):
+        return self.__binarized_fast[:, :self.__points]
+
+    def get_noise_params(self):
+        if self.__noise_n == 0:
+            return (np.full(self.__cells, np.nan),
+                    np.full(self.__cells, np.nan)
+                    )
+        mean = self.__noise_sum/self.__noise_n
+        variance = np.maximum(self.__noise_sum2/self.__noise_n - mean**2, 0)
+        return (mean, np.sqrt(variance))
+
+    def get_threshold(self):
+        return 3*self.get_noise_params()[1]
+
+    def to_data(self):
+        data = Data()
+        data.import_settings(self.__settings)
+        data.import_data(
+            np.column_stack((self.get_time(), self.get_signal().transpose()))
+            )
+        return data
+
+# ----------------------------- STREAMING METHODS -----------------------------
+
+    def push(self, frames):
+        if not len(frames.shape) == 2:
+            raise ValueError("Frames shape not 2D.")
+        if frames.shape[1] != self.__cells + 1:
+            raise ValueError("Cell number does not match.")
+        if len(frames) == 0:
+            return np.zeros((self.__cells, 0), bool)
+        block = np.asarray(frames[:, 1:], dtype=float).transpose()
+        start, stop = self.__points, self.__points + len(frames)
+
+        # Filter states start in steady state of the first frame
+        if self.__zi_slow is False:
+            self.__zi_slow = self.__initial_state(self.__sos_slow, block)
+            self.__zi_fast = self.__initial_state(self.__sos_fast, block)
+        slow, self.__zi_slow = sosfilt(
+            self.__sos_slow, block, axis=1, zi=self.__zi_slow
+            )
+        fast, self.__zi_fast = sosfilt(
+            self.__sos_fast, block, axis=1, zi=self.__zi_fast
+            )
+
+        # Update noise statistics with frames before stimulation
+        stimulation = int(self.__settings["Stimulation [frame]"][0])
+        noise = fast[:, :max(min(stimulation, stop) - start, 0)]
+        self.__noise_n += noise.shape[1]
+        self.__noise_sum += np.sum(noise, axis=1)
+        self.__noise_sum2 += np.sum(noise**2, axis=1)
+
+        # Frames are binarized with the noise estimate at their arrival
+        if self.__noise_n > 1:
+            binarized = fast > self.get_threshold()[:, np.newaxis]
+        else:
+            binarized = np.zeros(fast.shape, bool)
+
+        self.__reserve(stop)
+        self.__time[start:stop] = frames[:, 0]
+        self.__signal[:, start:stop] = block
+        self.__filtered_slow[:, start:stop] = slow
+        self.__filtered_fast[:, start:stop] = fast
+        self.__binarized_fast[:, start:stop] = binarized
+        self.__points = stop
+
+        return binarized
+
+    def __sos(self, lowcut, highcut, order=5):
+        nyq = 0.5*self.__settings["Sampling [Hz]"]
+        low = lowcut / nyq
+        high = highcut / nyq
+        return butter(
+            order, [low, high], analog=False, btype='band', output='sos'
+            )
+
+    def __initial_state(self, sos, block):
+        zi = sosfilt_zi(sos)
+        return zi[:, np.newaxis, :]*block[np.newaxis, :, 0, np.newaxis]
+
+    def __reserve(self, points):
+        capacity = self.__time.size
+        if points <= capacity:
+            return
+        # Buffers grow geometrically so appending is amortized constant time
+        while capacity < points:
+            capacity *= 2
+        self.__time = self.__grow(self.__time, capacity)
+        self.__signal = self.__grow(self.__signal, capacity)
+        self.__filtered_slow = self.__grow(self.__filtered_slow, capacity)
+        self.__filtered_fast = self.__grow(self.__filtered_fast, capacity)
+        self.__binarized_fast = self.__grow(self.__binarized_fast, capacity)
+
+    def __grow(self, buffer, capacity):
+        grown = np.empty(buffer.shape[:-1] + (capacity,), buffer.dtype)
+        grown[..., :self.__points] = buffer[..., :self.__points]
+        return grown
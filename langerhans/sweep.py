@@ -0,0 +1,187 @@
+import numpy as np
+
+import csv
+import copy
+import tempfile
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+from .data import Data, SAMPLE_SETTINGS, STAGE_SETTINGS, merge_settings
+from .analysis import Analysis
+from .cache import StageCache
+
+# Settings sub-keys read by any Data stage, the rest only select cells
+UPSTREAM = set(k for keys in STAGE_SETTINGS.values() for k in keys)
+
+
+def _path(key):
+    return tuple(key.split("/"))
+
+
+def _upstream(key):
+    path = _path(key)
+    return any(path[:len(k)] == k or k[:len(path)] == path
+               for k in UPSTREAM
+               )
+
+
+def _nested(values):
+    # Nested settings dict from {"Filter/Fast [Hz]": value, ...}
+    settings = {}
+    for key, value in values.items():
+        *parents, last = _path(key)
+        level = settings
+        for parent in parents:
+            level = level.setdefault(parent, {})
+        level[last] = value
+    return settings
+
+
+def _run_group(signal, positions, settings, autolimit, autoexclude, cache,
+               points):
+    # One upstream configuration, stages shared with other configurations
+    # are loaded from the cache
+    data = Data()
+    data.import_cache(cache)
+    data.import_settings(settings)
+    data.import_data(signal)
+    data.filter()
+    data.compute_distributions()
+    data.binarize_fast()
+    data.binarize_slow()
+    data.autolimit(autolimit)
+    if autoexclude:
+        data.autoexclude()
+
+    analyses = {}
+    parameters = {}
+    rows = []
+    for values in points:
+        ND_avg = values.get("ND_avg", 8)
+        data.update_settings(_nested(
+            {k: v for k, v in values.items() if k != "ND_avg"}
+            ))
+        good_cells = data.get_good_cells()
+        # Points selecting the same cells share their analysis and networks
+        mask = good_cells.tobytes()
+        if (mask, ND_avg) not in parameters:
+            if mask not in analyses:
+                analyses[mask] = Analysis()
+                analyses[mask].import_data(data, positions)
+            analysis = analyses[mask]
+            analysis.build_networks(ND_avg)
+            parameters[(mask, ND_avg)] = _summary(*analysis.get_parameters())
+        row = dict(values)
+        row["cells"] = int(np.sum(good_cells))
+        row.update(parameters[(mask, ND_avg)])
+        rows.append(row)
+    return rows
+
+
+def _summary(par_cell, par_network):
+    # Averages of cell parameters over good cells and of network parameters
+    # over edges, so every point is a single row of scalars
+    columns = {k: np.hstack([p[k] for p in par_cell])
+               for k in (par_cell[0] if par_cell else {})
+               }
+    if par_network is not False:
+        columns.update({k: np.hstack([v]) for k, v in par_network.items()})
+    summary = {}
+    for key, values in columns.items():
+        values = values.astype(float)
+        summary[key] = float(np.nanmean(values)) if values.size else np.nan
+    return summary
+
+
+class ParameterSweep(object):
+    """
+    Runs the pipeline over a grid of settings, e.g.
+
+    >> sweep = ParameterSweep(signal, positions, settings)
+    >> sweep.run({"Filter/Fast [Hz]": [[0.04, 0.4], [0.05, 0.5]],
+    >>            "Exclude/Score threshold": [0.5, 1, 1.5],
+    >>            "ND_avg": [6, 8, 10]
+    >>            }, workers=4)
+    >> sweep.to_csv("sweep.csv")
+
+    Grid keys are settings paths joined by "/" and ND_avg. Points are grouped
+    by the settings read by Data stages, exclusion thresholds and ND_avg
+    reuse the stages of their group. Groups share a StageCache, so each
+    stage is computed once per unique configuration of the settings it
+    reads, e.g. every filter band once. Without a cache a temporary one is
+    used for the run. Activity is fitted with the Data default "evolution",
+    "exact" is faster but its rows differ from a default run.
+    """
+# ------------------------------- INITIALIZER ---------------------------------
+    def __init__(self, signal, positions, settings=SAMPLE_SETTINGS,
+                 autolimit="evolution", autoexclude=True, cache=None
+                 ):
+        self.__signal = signal
+        self.__positions = positions
+        self.__settings = settings
+        self.__autolimit = autolimit
+        self.__autoexclude = autoexclude
+        self.__cache = cache
+        self.__results = False
+
+# --------------------------------- GETTERS -----------------------------------
+
+    def get_settings(self): return self.__settings
+    def get_cache(self): return self.__cache
+    def get_results(self): return self.__results
+
+# ------------------------------ SWEEP METHODS --------------------------------
+
+    def groups(self, grid):
+        keys = list(grid)
+        upstream = [k for k in keys if k != "ND_avg" and _upstream(k)]
+        groups = {}
+        for combination in itertools.product(*(grid[k] for k in keys)):
+            values = dict(zip(keys, combination))
+            group = tuple(repr(values[k]) for k in upstream)
+            groups.setdefault(group, []).append(values)
+        return list(groups.values())
+
+    def run(self, grid, workers=1):
+        if len(grid) == 0:
+            raise ValueError("Empty grid.")
+        groups = self.groups(grid)
+        print("Sweeping {0} points in {1} upstream configurations...".format(
+            sum(len(g) for g in groups), len(groups)
+            ))
+
+        if self.__cache is None:
+            with tempfile.TemporaryDirectory() as path:
+                return self.__run(groups, StageCache(path, np.inf), workers)
+        return self.__run(groups, self.__cache, workers)
+
+    def __run(self, groups, cache, workers):
+        arguments = []
+        for points in groups:
+            settings = copy.deepcopy(self.__settings)
+            upstream = {k: v for k, v in points[0].items()
+                        if k != "ND_avg" and _upstream(k)
+                        }
+            merge_settings(settings, _nested(upstream))
+            arguments.append((self.__signal, self.__positions, settings,
+                              self.__autolimit, self.__autoexclude, cache,
+                              points
+                              ))
+
+        if workers == 1:
+            results = [_run_group(*a) for a in arguments]
+        else:
+            with ProcessPoolExecutor(workers) as executor:
+                futures = [executor.submit(_run_group, *a) for a in arguments]
+                results = [f.result() for f in futures]
+        self.__results = [row for rows in results for row in rows]
+        return self.__results
+
+    def to_csv(self, path):
+        if self.__results is False:
+            raise ValueError("Sweep is not run.")
+        columns = list(dict.fromkeys(k for r in self.__results for k in r))
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(self.__results)